@@ -0,0 +1,237 @@
+#Benchmarks for the host side of inkkeys: startup, mode activation, rendering, serial traffic and input handling.
+#Runs against an in-process emulator of the firmware, so no device is needed. The results are printed as JSON
+#(or written to a file with -o), so they can be compared between versions.
+#
+#Usage: python benchmark.py [-o results.json] [-r repetitions]
+
+from inkkeys import *
+from inkkeys.emulator import DeviceEmulator
+from modes import *
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+BAUDRATE = 115200   #Used to estimate the time the data would take on the wire
+
+#Serial port replacement that feeds everything into an in-process emulator and hands its replies back to the device.
+#Time spent in the emulator is tracked separately, so it can be excluded from the host side measurements.
+class FakeSerial:
+    timeout = 1
+    name = "fake"
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.emulator.write = self.reply
+        self.input = bytearray()
+        self.writes = 0
+        self.bytes = 0
+        self.commands = {}
+        self.emulatorTime = 0
+
+    def reply(self, line):
+        self.input += (line + "\r\n").encode()
+
+    @property
+    def in_waiting(self):
+        return len(self.input)
+
+    def read(self, n=1):
+        data = bytes(self.input[:n])
+        del self.input[:n]
+        return data
+
+    def write(self, data):
+        start = time.perf_counter()
+        before = dict(self.emulator.commands)
+        self.emulator.receive(bytes(data))
+        for command, count in self.emulator.commands.items():
+            self.commands[command] = self.commands.get(command, 0) + count - before.get(command, 0)
+        self.writes += 1
+        self.bytes += len(data)
+        self.emulatorTime += time.perf_counter() - start
+        return len(data)
+
+    def close(self):
+        pass
+
+#Device that measures the time spent rendering images with PIL
+class BenchmarkDevice(Device):
+    renderTime = 0
+
+    def renderIcon(self, *args):
+        start = time.perf_counter()
+        img = Device.renderIcon(self, *args)
+        self.renderTime += time.perf_counter() - start
+        return img
+
+    def renderText(self, *args):
+        start = time.perf_counter()
+        img = Device.renderText(self, *args)
+        self.renderTime += time.perf_counter() - start
+        return img
+
+def connectedDevice(bufferWrites=True):
+    device = BenchmarkDevice()
+    device.ser = FakeSerial(DeviceEmulator())
+    device.inbuffer = LineSplitter()
+    device.bufferWrites = bufferWrites
+    device.refreshDelay = 0
+    device.maxRefreshDelay = 0
+    if not device.requestInfo(1):
+        raise RuntimeError("Emulator did not respond.")
+    return device
+
+def clearCaches():
+    Device.iconCache.clear()
+    Device.labelCache.clear()
+
+def measureActivation(device, mode):
+    ser = device.ser
+    writes, nbytes, emulatorTime, renderTime = ser.writes, ser.bytes, ser.emulatorTime, device.renderTime
+    commands = dict(ser.commands)
+    refreshes = device.refreshCount
+    start = time.perf_counter()
+    device.activateMode(mode)
+    device.refreshIfDue()
+    device.flush()
+    wall = time.perf_counter() - start
+    sentBytes = ser.bytes - nbytes
+    return {
+        "hostTime": wall - (ser.emulatorTime - emulatorTime),
+        "renderTime": device.renderTime - renderTime,
+        "bytes": sentBytes,
+        "writes": ser.writes - writes,
+        "commands": {command: count - commands.get(command, 0) for command, count in ser.commands.items() if count - commands.get(command, 0) > 0},
+        "refreshes": device.refreshCount - refreshes,
+        "estimatedWireTime": sentBytes * 10 / BAUDRATE,
+    }
+
+def summarize(samples):
+    return {key: (sorted(sample[key] for sample in samples)[len(samples)//2] if not isinstance(samples[0][key], dict) else samples[-1][key]) for key in samples[0]}
+
+#Activates each mode on a fresh device with empty caches (cold) and then again after switching through another mode (warm,
+#replayed from the snapshot for modes that allow it)
+def benchmarkModes(repetitions):
+    results = {}
+    modeClasses = [ModeAltium, ModeZoom, ModeMicrosoftTeams, ModeTest, ModeFallback]
+    for modeClass in modeClasses:
+        cold = []
+        warm = []
+        for i in range(repetitions):
+            clearCaches()
+            device = connectedDevice()
+            mode = modeClass()
+            cold.append(measureActivation(device, mode))
+            other = modeClasses[(modeClasses.index(modeClass) + 1) % len(modeClasses)]()
+            device.activateMode(other)
+            device.refreshIfDue()
+            device.flush()
+            warm.append(measureActivation(device, mode))
+        results[modeClass.__name__] = {"cold": summarize(cold), "warm": summarize(warm)}
+    return results
+
+def timePerCall(function, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        function(i)
+    return (time.perf_counter() - start) / calls
+
+def benchmarkRendering(repetitions):
+    device = connectedDevice()
+    icons = ["icons/mic.png", "icons/camera-video.png", "icons/chat-dots.png", "icons/aspect-ratio.png"]
+    def icon(i):
+        device.resetFramebuffer()
+        device.sendIconFor(2 + i % 8, icons[i % len(icons)])
+    def text(i):
+        device.resetFramebuffer()
+        device.sendTextFor(2 + i % 8, "SW" + str(i % 8), "Sub")
+    def coldIcon(i):
+        clearCaches()
+        icon(i)
+    def atlasIcon(i):
+        device.iconAtlas = defaultAtlasPath
+        icon(i)
+        device.iconAtlas = None
+    def coldText(i):
+        clearCaches()
+        text(i)
+    calls = 20 * repetitions
+    atlas = loadAtlas(defaultAtlasPath)
+    device.iconAtlas = None #Measure rendering from the PNG files first
+    return {
+        "sendIconFor": {"cold": timePerCall(coldIcon, calls), "warm": timePerCall(icon, calls), "atlas": timePerCall(atlasIcon, calls) if atlas != None else None},
+        "iconAtlas": atlas.stats() if atlas != None else None,
+        "sendTextFor": {"cold": timePerCall(coldText, calls), "warm": timePerCall(text, calls)},
+        "iconCache": Device.iconCache.stats(),
+        "labelCache": Device.labelCache.stats(),
+    }
+
+#Queues a burst of jog steps and measures how long it takes until all of them have been delivered to the callback
+def benchmarkJogBurst(steps):
+    device = connectedDevice()
+    received = []
+    device.registerCallback(lambda value: received.append(value), KeyCode.JOG)
+    for i in range(steps):
+        device.ser.reply(KeyCode.JOG.value + "1")
+    start = time.perf_counter()
+    polls = 0
+    while sum(received) < steps:
+        device.poll()
+        polls += 1
+    return {"steps": steps, "time": time.perf_counter() - start, "polls": polls, "callbacks": len(received)}
+
+#Run in a fresh interpreter: imports inkkeys and the modes like the controller does and then connects to an emulated
+#device, so it shows how long it takes until the pad can be used and which heavy modules had to be loaded for it.
+startupCode = """
+import contextlib, json, sys, time
+start = time.perf_counter()
+import inkkeys
+imported = time.perf_counter()
+import modes
+modesImported = time.perf_counter()
+loaded = [module for module in ("PIL", "serial", "numpy", "psutil", "asyncio", "Xlib") if module in sys.modules]
+import benchmark
+with contextlib.redirect_stdout(sys.stderr):
+    connecting = time.perf_counter()
+    benchmark.connectedDevice()
+    connected = time.perf_counter()
+print(json.dumps({"importInkkeys": imported - start, "importModes": modesImported - imported, "requestInfo": connected - connecting, "total": modesImported - start + connected - connecting, "modulesLoadedByImport": loaded}))
+"""
+
+def benchmarkStartup(repetitions):
+    samples = []
+    for i in range(repetitions):
+        result = subprocess.run([sys.executable, "-c", startupCode], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        samples.append(json.loads(result.stdout))
+    return {key: (sorted(sample[key] for sample in samples)[len(samples)//2] if not isinstance(samples[0][key], list) else samples[-1][key]) for key in samples[0]}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mode activation, rendering and serial traffic of the inkkeys controller.")
+    parser.add_argument("-o", "--output", help="Write results to this file instead of stdout")
+    parser.add_argument("-r", "--repetitions", type=int, default=5, help="Repetitions per measurement (the median is reported)")
+    parser.add_argument("-j", "--jog-steps", type=int, default=1000, help="Number of jog steps in the input burst")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr): #Keep the output of the device (connection info etc.) out of the results
+        results = {
+            "python": sys.version.split(" ")[0],
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "startup": benchmarkStartup(args.repetitions),
+            "modes": benchmarkModes(args.repetitions),
+            "rendering": benchmarkRendering(args.repetitions),
+            "jogBurst": benchmarkJogBurst(args.jog_steps),
+        }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
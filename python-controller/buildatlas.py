@@ -0,0 +1,15 @@
+#Builds the icon atlas (see inkkeys/atlas.py), so the controller does not need to decode PNG files for the icons.
+#Run this again after adding or changing icons. Icons that have been changed since are rendered from the PNG file.
+
+from inkkeys import buildAtlas
+import argparse
+
+parser = argparse.ArgumentParser(description="Build the icon atlas used by Device.sendIconFor.")
+parser.add_argument("directory", nargs="?", default="icons", help="Directory with the PNG icons")
+parser.add_argument("-o", "--output", help="Atlas file to write (default: icons.atlas in the icon directory)")
+parser.add_argument("--width", type=int, default=128, help="Display width")
+parser.add_argument("--height", type=int, default=296, help="Display height")
+args = parser.parse_args()
+
+count = buildAtlas(args.directory, args.output, args.width, args.height)
+print("Wrote " + str(count) + " icons.")
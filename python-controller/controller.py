@@ -1,11 +1,19 @@
-SERIALPORT = None #None = Auto-detect, to specify a specific serial port, you can set it to something like "/dev/ttyACM0" (Linux) or "COM1" (Windows)
+SERIALPORT = None #None = Auto-detect all connected devices, to specify a specific serial port, you can set it to something like "/dev/ttyACM0" (Linux) or "COM1" (Windows)
 VID = 0x2341      #USB Vendor ID for a Pro Micro
 PID = 0x8037      #USB Product ID for a Pro Micro
 DEBUG = True     #More output on the command line
+BUFFER_WRITES = True #Collect everything sent to the device during one iteration of the main loop and send it with a single write
+METRICS_FILE = None  #Set to a file name to periodically export metrics, i.e. "/var/lib/node_exporter/textfile/inkkeys.prom" for Prometheus or "inkkeys-metrics.json" for JSON
+METRICS_INTERVAL = 10 #Export interval for the metrics in seconds
+READER_THREAD = True #Read from the device in a background thread, so key presses are handled immediately instead of once per frame
+RETRY_INTERVAL = 3   #Seconds to wait before trying to connect to a port again
+POLL_INTERVAL = 1    #Seconds between checks for new serial ports if hot-plug events are not available (Linux with pyudev)
 
 from inkkeys import *        #Inkkeys module
 from processchecks import *  #Functions to check for active processes and windows
 from modes import *          #Definitions of the hotkey functions in different "modes"
+from modematcher import *    #Decides which mode to use
+from hotplug import *        #Notifications about new serial ports
 #from mqtt import InkkeysMqtt #A small class to encapsule MQTT specific functions. You will need to adapt this to your needs if you want to use this.
 
 import time                         #Time functions
@@ -13,6 +21,8 @@ from serial import SerialException  #Serial functions
 import serial.tools.list_ports      #Function to iterate over serial ports
 import re                           #Regular expressions process name matching
 import traceback                    #Print tracebacks if an error is thrown and caught
+import heapq                        #Deadlines of the main loop
+from threading import Event, Lock, Thread #Each device is handled in its own thread
 
 print("https://there.oughta.be/a/macro-keyboard")
 print('I will try to stay connected. Press Ctrl+c to quit.')
@@ -27,91 +37,162 @@ print('I will try to stay connected. Press Ctrl+c to quit.')
 #(mode would be active whenever the process runs) or an active window (mode is active if the window has
 #the focus. The latter is a compiled regular expression pattern. Mode priority corresponds to the order in the
 #list, so the first mode with a matching process or active window will be activated.
+#Modes are given as classes. Each connected device gets its own mode objects, which are only created when the mode
+#is used for the first time.
 
 #mqtt = InkkeysMqtt("None", DEBUG) #Set address to "None" if you do not want to use mqtt
 
 modes = [\
-#            {"mode": ModeOBS(), "process": "obs"}, \
-#            {"mode": ModeBlender(), "activeWindow": re.compile("^Blender")}, \
-            {"mode": ModeAltium(), "activeWindow": re.compile(".*Altium")}, \
-            {"mode": ModeZoom(), "activeWindow": re.compile(".*Zoom")}, \
-            {"mode": ModeMicrosoftTeams(), "activeWindow": re.compile(".*Microsoft Teams")}, \
-            {"mode": ModeTest(), "activeWindow": re.compile("test - Google Search — Mozilla Firefox")}, \
-            {"mode": ModeFallback()} \
+#            {"mode": ModeOBS, "process": "obs"}, \
+#            {"mode": ModeBlender, "activeWindow": re.compile("^Blender")}, \
+            {"mode": ModeAltium, "activeWindow": re.compile(".*Altium")}, \
+            {"mode": ModeZoom, "activeWindow": re.compile(".*Zoom")}, \
+            {"mode": ModeMicrosoftTeams, "activeWindow": re.compile(".*Microsoft Teams")}, \
+            {"mode": ModeTest, "activeWindow": re.compile("test - Google Search — Mozilla Firefox")}, \
+            {"mode": ModeFallback} \
         ]
 
+watchProcesses(i["process"] for i in modes if "process" in i) #Only keep track of the processes the modes are interested in
+
 ############################################################################################################
 
 # Usually there should not be anything to be customized below this point
 
 ############################################################################################################
 
+loopMetric = metrics.histogram("inkkeys_loop_seconds", "Duration of one iteration of the main loop (without waiting for the next frame)")
+loopOverrunMetric = metrics.counter("inkkeys_loop_overruns_total", "Iterations of the main loop that took longer than one frame at 30 fps")
+processesMetric = metrics.histogram("inkkeys_get_active_processes_seconds", "Time spent in getActiveProcesses")
+windowMetric = metrics.histogram("inkkeys_get_active_window_seconds", "Time spent in getActiveWindow")
+jitterMetric = metrics.histogram("inkkeys_frame_jitter_seconds", "Delay of LED animation frames relative to their deadline", (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.0333, 0.05, 0.1, 0.25))
+
+#Processes and the active window are checked by a background thread (see ContextProbe in processchecks.py), which
+#wakes up the main loop if anything has changed. So neither a process scan nor the X server can delay key callbacks or
+#LED animation.
+def probeProcesses():
+    with processesMetric.time():
+        return getActiveProcesses()
+
+def probeWindow():
+    with windowMetric.time():
+        return getActiveWindow()
+
+def onContextChanged(snapshot):
+    deviceManager.notifyAll()   #Wake up the main loops of all devices
+
+contextProbe = ContextProbe(onContextChanged, probeProcesses, probeWindow)
+
 #If we found the device, successfully connected and retreived its information, we enter this work function,
 #which primarily consists of an infinite loop that only returns if we hit Ctrl+C (or kill the process).
+#Instead of running at a fixed frame rate, the loop keeps a heap of deadlines for its tasks (polling the mode and
+#animating LEDs) and sleeps until the earliest one, until a key event arrives or until the context probe reports a
+#change. LED frames are only scheduled while the LEDs fade or the mode's animate function asks for more frames, so
+#the loop hardly ever wakes up on an idle desktop.
 
-def work():
+FRAME_INTERVAL = 1/30       #Time between LED animation frames (30 fps)
+MAX_SLEEP = 10.0            #Longest time the loop sleeps without anything to do
+
+def work(worker):
+    device = worker.device
+    modeMatcher = worker.modeMatcher
+    contextChanged = worker.contextChanged
     mode = None             #Current mode of the device (i.e. key mappings for specific process).
-    pollInterval = 0        #Polling interval as requested by the module when the last call to "poll" was made
-    lastPoll = 0            #Keeps track of the last time the poll function of the mode instance was called
-    lastProcessList = 0     #Keeps track of the last time the list of processes was retrieved
-    lastModeCheck = 0       #Keeps track of the last time the current window was checked and a decision about the mode was made
-#    mqtt.connect()          #Connect to the MQTT server (if used)
-    try:
-        while True:     #Now we are in our main, infinite loop -------------------
-            now = time.time() #Time of this iteration
-
-            if now - lastProcessList > 5.0:      # Only check the process list every 5 seconds.
-                processes = getActiveProcesses() # This is a surprisingly expensive and slow call, so don't overdo as it might prevent smooth LED animation (fixable by implementing a second thread) and burn more CPU resources than you might want from a background process
-                lastProcessList = now
-
-            if now - lastModeCheck > 0.5:       # Check active window and decide which mode to use. This can be done more regularly, but since the e-ink screen takes a moment to update, it does not make sense to check more frequently
-                window = getActiveWindow()      # Get the currently active window
-                if window != None:              # Sometime getting the active window fails, then ignore it. (Some window managers allow having no window in focus)
-                    activeWindow = window
-                    if DEBUG:                   #Enable DEBUG to see the actual name of the current window if you need it to match your modules
-                        print("Active window: " + str(activeWindow))
-
-                for i in modes:                 #Iterate over modes and use the first one that matches
-                    if ("process" in i and i["process"] in processes) or ("activeWindow" in i and i["activeWindow"].match(activeWindow)) or not ("process" in i or "activeWindow" in i):
-                        #Either the process for this mode is running or the active window matches the regular expression. This is the mode we will set now.
-                        if i["mode"] != mode:           # Do not set the mode again if we already have this one
-                            if mode != None:            
-                                mode.deactivate(device) # If there was a previous mode, call its deactivate function
-                                device.sendLedAnimation(2, 50, 20, r=255, b=255, iteration=2, lednumber=0)
-                            mode = i["mode"]            # Set new mode
-                            mode.activate(device)       # ...and call its activate function
-                            pollInterval = 0            # Reset the poll intervall to call mode.poll() at least once (see below)
-                        break
-                lastModeCheck = now
-
-            if pollInterval >= 0 and now - lastPoll > pollInterval:    #Regularly call the poll function of the mode if it requires regular polling
+    activeWindow = None     #Last known active window
+    schedule = []           #Heap of (deadline, task)
+    deadlines = {}          #Current deadline of each task. Heap entries with a different deadline are outdated and skipped.
+    animating = False       #The mode's animate function asked for another frame
+
+    def at(deadline, task): #Schedules a task, unless it is already scheduled earlier
+        if task not in deadlines or deadline < deadlines[task]:
+            deadlines[task] = deadline
+            heapq.heappush(schedule, (deadline, task))
+
+    def scheduleFrame(now): #LED frames are only needed while something is animated
+        if "frame" in deadlines:
+            return
+        ledDeadline = device.ledDeadline()
+        if animating or (ledDeadline != None and ledDeadline <= now):
+            at(now, "frame")
+        elif ledDeadline != None:
+            at(ledDeadline, "frame")
+
+    at(0, "modeCheck")
+    while not stopping.is_set():    #Now we are in our main loop -------------------
+        now = time.time() #Time of this iteration
+
+        if contextChanged.is_set():         # The context probe reported a different window or process list
+            contextChanged.clear()
+            at(now, "modeCheck")
+
+        while len(schedule) > 0 and schedule[0][0] <= now:
+            deadline, task = heapq.heappop(schedule)
+            if deadlines.get(task) != deadline:
+                continue    #Rescheduled in the meantime
+            del deadlines[task]
+
+            if task == "modeCheck":         # Decide which mode to use
+                context = contextProbe.snapshot
+                if DEBUG and context.window != activeWindow: #Enable DEBUG to see the actual name of the current window if you need it to match your modules
+                    print("Active window: " + str(context.window))
+                activeWindow = context.window
+
+                newMode = modeMatcher.match(activeWindow, context.processes) #The first mode for which the process is running or the active window matches the regular expression
+                if newMode != None and newMode != mode:    # Do not set the mode again if we already have this one
+                    if mode != None:
+                        mode.deactivate(device)     # If there was a previous mode, call its deactivate function
+                        device.sendLedAnimation(2, 50, 20, r=255, b=255, iteration=2, lednumber=0)
+                    mode = newMode                  # Set new mode
+                    device.activateMode(mode)       # ...and call its activate function (or replay what it did the last time)
+                    deadlines.pop("modePoll", None) # Call mode.poll() right away (see below)
+                    at(now, "modePoll")
+                    animating = True                # Give the new mode a chance to start its animation
+
+            elif task == "modePoll":        #Regularly call the poll function of the mode if it requires regular polling
                 #The poll function returns the desired interval when it should be called next - or False if polling is not required in this mode
                 pollInterval = mode.poll(device)
-                lastPoll = now
+                if pollInterval is not False and pollInterval != None and pollInterval >= 0:
+                    at(now + pollInterval, "modePoll")
 
-            #Now for the functions that need to be called very often and fast:
-            mode.animate(device)    #Used for LED animations
-            device.poll()           #Required for the callbacks that are associated with key presses reported via serial
+            elif task == "frame":
+                jitterMetric.observe(now - deadline)
+                animating = mode.animate(device) == True #Used for LED animations. Returns True if it needs another frame.
+                ledDeadline = device.ledDeadline()
+                if animating:
+                    at(max(deadline + FRAME_INTERVAL, now), "frame")
+                elif ledDeadline != None:   #Skip the frames while the LEDs are just on
+                    at(max(deadline + FRAME_INTERVAL, now, ledDeadline), "frame")
 
-            #If the actions so far did take less than 1/30 seconds, sleep until 1/30s have passed as there is no need to exceed 30fps
-            timeTo30fps = time.time() - now + 0.0333
-            if timeTo30fps > 0:
-                time.sleep(timeTo30fps)
-                    #End of main loop -------------------------------------------
+        scheduleFrame(now)      #Key callbacks and mode changes may have started a fade
+        device.refreshIfDue()   #Refresh the display if a mode requested it. Several requests in quick succession only lead to a single refresh
+        device.flush()          #Send everything that has been collected during this iteration (if BUFFER_WRITES is set)
 
+        iterationTime = time.time() - now
+        loopMetric.observe(iterationTime)
+        if iterationTime > FRAME_INTERVAL:
+            loopOverrunMetric.inc()
 
-    except KeyboardInterrupt:       #User pressed Ctrl+c
-#        mqtt.disconnect()
-        print('Disconnected from device. Hit Ctrl+c again to quit before reconnect.')
+        #Sleep until the next deadline. With the reader thread, key presses and context changes wake us up right away,
+        #otherwise we need to wake up regularly to check for key presses.
+        wakeup = schedule[0][0] if len(schedule) > 0 else now + MAX_SLEEP
+        refreshDeadline = device.refreshDeadline()
+        if refreshDeadline != None:
+            wakeup = min(wakeup, refreshDeadline)
+        if device.readerThread == None:
+            wakeup = min(wakeup, now + FRAME_INTERVAL)
+        timeout = wakeup - time.time()
+        if device.poll(timeout if timeout > 0 else 0): #Required for the callbacks that are associated with key presses reported via serial
+            scheduleFrame(time.time())
+                #End of main loop -------------------------------------------
 
 
 #Try connecting on the given port and work with it.
 #Will return false if connection fails or an unknown device is present.
-#If it succeeds, it will enter the main working loop forever. It will only return if an error occurs and return True to report that it was working with the correct device.
-def tryUsingPort(port):
+#If it succeeds, it will enter the main working loop until the device is disconnected or we quit. It will only return if an error occurs (or we quit) and return True to report that it was working with the correct device.
+def tryUsingPort(worker):
+    device = worker.device
     try:
-        if device.connect(port):
-            work()  #Success, enter main loop
+        if device.connect(worker.port):
+            work(worker)  #Success, enter main loop
             device.disconnect()
             return True
     except SerialException as e:
@@ -121,24 +202,102 @@ def tryUsingPort(port):
         if DEBUG:
             print(traceback.format_exc())
         print("Error: ", sys.exc_info()[0])
+    if device.ser != None:
+        device.disconnect()
     return False
 
-# Instantiate the device
-device = Device()
-device.debug = DEBUG
+#Everything that belongs to one device: the device object, its own modes and the thread working with it. Each device
+#has its own thread, so one device waiting for a slow e-ink refresh does not delay another. The render caches of the
+#Device class are shared, so an icon used on several devices is only rendered once.
+class DeviceWorker:
+    def __init__(self, port):
+        self.port = port
+        self.device = Device()
+        self.device.debug = DEBUG
+        self.device.threadedInput = READER_THREAD
+        self.device.bufferWrites = BUFFER_WRITES
+        self.modeMatcher = ModeMatcher(modes) #Creates the mode objects for this device and remembers which mode matches a window and set of processes, so the list is not evaluated over and over again
+        self.contextChanged = Event()   #Set by the context probe, so the mode is checked right away
+        self.thread = None
+        self.present = False            #The port has been found in the last scan
+        self.lastAttempt = 0            #Last time we tried to connect
+
+    def isRunning(self):
+        return self.thread != None and self.thread.is_alive()
+
+    def start(self):
+        self.lastAttempt = time.time()
+        self.thread = Thread(target=self.run, name="inkkeys-" + self.port, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        tryUsingPort(self)
+        if not stopping.is_set():
+            print("Lost " + self.port + ". I will retry in " + str(RETRY_INTERVAL) + " seconds or when it is plugged in again...")
+
+    def notify(self):
+        self.contextChanged.set()
+        self.device.wake()
+
+#Finds all connected devices (or the one given by SERIALPORT) and starts a worker for each of them
+class DeviceManager:
+    def __init__(self):
+        self.workers = {}   #Port to DeviceWorker
+        self.lock = Lock()
+
+    def findPorts(self):
+        if SERIALPORT != None:  #Explicit port has been defined
+            return [SERIALPORT]
+        return [port.device for port in serial.tools.list_ports.comports() if port.vid == VID and port.pid == PID] #Skip ports if vendor or product ID do not match
+
+    #Starts workers for new devices and for those that lost their connection. A device that has just been plugged in
+    #is used right away, otherwise we wait RETRY_INTERVAL between attempts. Workers (and with them the last known state
+    #of the device) are kept when a device is unplugged, so it can be restored when it is plugged in again.
+    def scan(self):
+        now = time.time()
+        with self.lock:
+            ports = self.findPorts()
+            for port, worker in self.workers.items():
+                if port not in ports:
+                    worker.present = False
+            for port in ports:
+                if port not in self.workers:
+                    self.workers[port] = DeviceWorker(port)
+                worker = self.workers[port]
+                if not worker.isRunning() and (not worker.present or now - worker.lastAttempt >= RETRY_INTERVAL):
+                    worker.start()
+                worker.present = True
+
+    def notifyAll(self):
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.notify()
+
+    def stop(self):
+        stopping.set()
+        self.notifyAll()
+        for worker in list(self.workers.values()):
+            if worker.isRunning():
+                worker.thread.join(5)
+
+stopping = Event() #Set to quit the main loops of all devices
+deviceManager = DeviceManager()
+if watchActiveWindow(lambda window: contextProbe.probeWindow()): #If this is not supported on this platform, getActiveWindow() is polled by the context probe
+    contextProbe.windowInterval = None
+contextProbe.start()
+if METRICS_FILE != None:
+    metrics.startExport(METRICS_FILE, METRICS_INTERVAL)
+#mqtt.connect()          #Connect to the MQTT server (if used)
+portsChanged = Event() #Set if a serial port has been added or removed
+hotplugWatched = watchSerialPorts(lambda action, port: portsChanged.set()) #If this is not supported, the ports are polled every POLL_INTERVAL seconds
 try:
     while True:
-        if SERIALPORT != None:  #Explicit port has been defined
-            tryUsingPort(SERIALPORT)
-        else:                   #No explicit port defined. Search for the device
-            for port in serial.tools.list_ports.comports(): #Iterate over all serial ports
-                if port.vid != VID or port.pid != PID:
-                    continue                                #Skip if vendor or product ID do not match
-                if tryUsingPort(port.device):               #Try connecting to this device
-                    break                                   #Connection was successful and inkkeys was found. If we reach this point, we do not need to search on another port. We got disconnected or some other kind of error, so skip the rest of the port list and start over.
-        print("I will retry in three seconds...")
-        time.sleep(3)
+        deviceManager.scan()
+        portsChanged.wait(RETRY_INTERVAL if hotplugWatched else POLL_INTERVAL)
+        portsChanged.clear()
 except KeyboardInterrupt:       #User pressed Ctrl+c
+#    mqtt.disconnect()
+    print('Disconnecting...')
+    deviceManager.stop()
     print('Ok, bye.')
-
-
@@ -0,0 +1,28 @@
+import sys
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None #Optional, without it the serial ports have to be polled
+
+observer = None
+
+#Calls callback(action, port) as soon as a serial port is added or removed (i.e. "add" and "/dev/ttyACM0"), so a
+#device can be used right after it has been plugged in. This uses udev and therefore only works on Linux with pyudev
+#installed. Returns False if hot-plug events are not available and the ports need to be polled instead.
+def watchSerialPorts(callback):
+    global observer
+    if pyudev == None or sys.platform not in ['linux', 'linux2']:
+        return False
+    if observer == None:
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by("tty")
+            observer = pyudev.MonitorObserver(monitor, callback=lambda device: callback(device.action, device.device_node), name="inkkeys-hotplug")
+            observer.daemon = True
+            observer.start()
+        except Exception:
+            print("Could not watch serial ports: ", sys.exc_info()[0])
+            observer = None
+            return False
+    return True
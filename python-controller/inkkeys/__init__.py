@@ -1,3 +1,8 @@
 from .protocol import *
+from .cache import *
+from .metrics import *
+from .snapshot import *
+from .leds import *
+from .atlas import *
 from .device import *
-
+from .asyncdevice import *
@@ -0,0 +1,249 @@
+from .protocol import *
+from .device import Device, LineSplitter, parseEvent, coalesceEvents, keyDispatchMetric
+import os
+import time
+
+#Asyncio variant of Device for controllers that need to handle other I/O (MQTT, websockets...) in the same thread.
+#Rendering (getAreaFor, sendTextFor, sendIconFor...) is inherited from Device, but writes are always buffered and the
+#awaitable methods write the buffer without blocking the event loop. Input is read whenever the event loop reports the
+#serial port as readable, so there are no polling sleeps.
+#The blocking methods of Device (flush, poll, readFromDevice, requestInfo, updateDisplay and refreshIfDue) are not
+#supported, as they would read and write the non-blocking port next to the event loop. They raise an error that names
+#the awaitable method to use instead (drain, events, request_info, update_display and refresh_if_due).
+#This requires a serial port with a file descriptor, so it does not work on Windows.
+#asyncio and pyserial are only imported on connect, so importing inkkeys stays fast for controllers without asyncio.
+#
+#Usage:
+#    device = AsyncDevice()
+#    if await device.connect("/dev/ttyACM0"):
+#        await device.send_icon_for(2, "icons/mic.png")
+#        await device.update_display()
+#        async for key, value in device.events():
+#            ...
+
+class AsyncDevice(Device):
+    loop = None
+    fd = None
+    asyncResponseLock = None
+    asyncDrainLock = None   #Only one drain writes at a time, so commands are not interleaved and only one writer is installed
+    asyncError = None       #Exception that stopped reading from the serial port
+
+    async def connect(self, dev, timeout=3):
+        import asyncio
+        import serial
+        print("Connecting to ", dev, ".")
+        self.loop = asyncio.get_running_loop()
+        self.ser = serial.Serial(dev, 115200, timeout=0)
+        self.fd = self.ser.fileno()
+        os.set_blocking(self.fd, False)
+        self.inbuffer = LineSplitter()
+        self.bufferWrites = True #Commands are only written by drain()
+        self.outbuffer = bytearray()
+        self.eventQueue = asyncio.Queue()
+        self.responseQueue = asyncio.Queue()
+        self.asyncResponseLock = asyncio.Lock()
+        self.asyncDrainLock = asyncio.Lock()
+        self.asyncError = None
+        self.loop.add_reader(self.fd, self.onReadable)
+        if not await self.request_info(timeout):
+            self.disconnect()
+            return False
+        if self.testmode:
+            print("Connection to ", self.ser.name, " was successfull, but the device is running the hardware test firmware, which cannot be used for anything but testing. Please flash the proper inkkeys firmware to use it.")
+            return False
+        print("Connected to ", self.ser.name, ".")
+        return True
+
+    def disconnect(self):
+        if self.fd != None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.fd = None
+        if self.ser != None:
+            self.ser.close()
+            self.ser = None
+
+    def unsupported(self, method, alternative):
+        raise NotImplementedError("AsyncDevice does not support the blocking " + method + "(), use " + alternative + " instead.")
+
+    def flush(self):
+        self.unsupported("flush", "await drain()")
+
+    def poll(self, timeout=0):
+        self.unsupported("poll", "async for ... in events()")
+
+    def readFromDevice(self, timeout=0):
+        self.unsupported("readFromDevice", "events() or await readResponse()")
+
+    def requestInfo(self, timeout):
+        self.unsupported("requestInfo", "await request_info()")
+
+    def updateDisplay(self, fullRefresh=True, timeout=5):
+        self.unsupported("updateDisplay", "await update_display()")
+
+    def refreshIfDue(self):
+        self.unsupported("refreshIfDue", "await refresh_if_due()")
+
+    #Called by the event loop when there is data to read
+    def onReadable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(e)
+            return
+        if len(data) == 0:
+            import serial
+            self.fail(serial.SerialException("Device disconnected."))
+            return
+        self.inbuffer.feed(data)
+        line = self.inbuffer.readLine()
+        while line != None:
+            if self.debug:
+                print("Received: " + line)
+            event = parseEvent(line)
+            if event != None:
+                self.eventQueue.put_nowait((event, time.time()))
+            else:
+                self.responseQueue.put_nowait(line)
+            line = self.inbuffer.readLine()
+
+    def fail(self, error):
+        self.asyncError = error
+        self.loop.remove_reader(self.fd)
+        self.eventQueue.put_nowait(None)
+        self.responseQueue.put_nowait(None)
+
+    #Writes everything that has been sent so far. Waits for the serial port to become writable instead of blocking.
+    #Concurrent drains wait for each other, so a command (i.e. the payload of a DISPLAY command) is never split by the
+    #data of another drain. Whatever has been sent while waiting is written by the drain that takes the buffer next.
+    async def drain(self):
+        async with self.asyncDrainLock:
+            if len(self.outbuffer) == 0:
+                return
+            data = self.outbuffer
+            self.countFlush()
+            while len(data) > 0:
+                try:
+                    n = os.write(self.fd, data)
+                    del data[:n]
+                except BlockingIOError:
+                    pass
+                if len(data) > 0:
+                    writable = self.loop.create_future()
+                    self.loop.add_writer(self.fd, lambda: writable.done() or writable.set_result(None))
+                    try:
+                        await writable
+                    finally:
+                        if self.fd != None:
+                            self.loop.remove_writer(self.fd)
+
+    #Returns the next response line or None if the deadline (in loop time) has passed
+    async def readResponse(self, deadline):
+        import asyncio
+        try:
+            line = await asyncio.wait_for(self.responseQueue.get(), max(0, deadline - self.loop.time()))
+        except asyncio.TimeoutError:
+            return None
+        if line == None:
+            raise self.asyncError
+        return line
+
+    async def waitForResponse(self, expected, deadline):
+        line = await self.readResponse(deadline)
+        while line != expected:
+            if line == None:
+                return False
+            line = await self.readResponse(deadline)
+        return True
+
+    async def request_info(self, timeout):
+        async with self.asyncResponseLock:
+            print("Requesting device info...")
+            deadline = self.loop.time() + timeout
+            self.sendToDevice(CommandCode.INFO.value)
+            await self.drain()
+            line = await self.readResponse(deadline)
+            while line != "Inkkeys":
+                if line == None:
+                    return False
+                print("Skipping: ", line)
+                line = await self.readResponse(deadline)
+            print("Header found. Waiting for infos...")
+            line = await self.readResponse(deadline)
+            while line != "Done":
+                if line == None:
+                    return False
+                self.parseInfoLine(line)
+                line = await self.readResponse(deadline)
+            self.printInfo()
+            self.restoreDeviceState()
+            return True
+
+    async def send_image(self, x, y, image):
+        self.sendImage(x, y, image)
+        await self.drain()
+
+    async def send_text_for(self, function, text, subtext="", inverted=False):
+        self.sendTextFor(function, text, subtext, inverted)
+        await self.drain()
+
+    async def send_icon_for(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
+        self.sendIconFor(function, icon, inverted, centered, marked, crossed)
+        await self.drain()
+
+    async def assign_key(self, key, sequence):
+        self.assignKey(key, sequence)
+        await self.drain()
+
+    async def assign_keys(self, assignments):
+        self.assignKeys(assignments)
+        await self.drain()
+
+    async def set_leds(self, leds):
+        self.setLeds(leds)
+        await self.drain()
+
+    #Refreshes the display if requested via requestRefresh() (see Device.refreshIfDue)
+    async def refresh_if_due(self):
+        full = self.dueRefresh()
+        if full == None:
+            return False
+        return await self.update_display(full)
+
+    async def update_display(self, fullRefresh=True, timeout=5):
+        async with self.asyncResponseLock:
+            start = time.time()
+            deadline = self.loop.time() + timeout
+            self.sendToDevice(CommandCode.REFRESH.value + " " + (RefreshTypeCode.FULL.value if fullRefresh else RefreshTypeCode.PARTIAL.value))
+            await self.drain()
+            if not await self.waitForResponse("ok", deadline):
+                return False
+            refreshed = time.time()
+            self.resendImageData()
+            self.sendToDevice(CommandCode.REFRESH.value + " " + RefreshTypeCode.OFF.value)
+            await self.drain()
+            if not await self.waitForResponse("ok", deadline):
+                return False
+            self.countRefresh(fullRefresh, start, refreshed)
+            return True
+
+    #Async iterator over key and jog events as (key, value) tuples, with key being the value of the KeyCode (i.e. "2p"
+    #or "R" for the jog wheel) and value being the rotation for jog events and None otherwise. Jog events that are
+    #queued up are combined into one (see Device.dispatchEvents).
+    #Callbacks registered with registerCallback are called as well before an event is returned.
+    async def events(self):
+        while True:
+            items = [await self.eventQueue.get()]
+            while not self.eventQueue.empty():
+                items.append(self.eventQueue.get_nowait())
+            failed = None in items
+            for event, first, last, count in coalesceEvents([item for item in items if item != None]):
+                keyDispatchMetric.observe(time.time() - first)
+                if event[0] == KeyCode.JOG.value:
+                    self.updateJog(event[1], first, last, count)
+                self.dispatchEvent(event)
+                yield event
+            if failed:
+                raise self.asyncError
@@ -0,0 +1,114 @@
+#A prebuilt atlas of all icons, so sendIconFor does not need to open and decode PNG files. The atlas holds each icon
+#already rendered for the standard button area (as returned by Device.getAreaFor), converted to 1-bit and rotated to
+#the device orientation, once normal and once inverted. At runtime, the file is memory-mapped and the payloads are
+#handed out as memoryview slices without copying them.
+#Only centered icons without marker and cross are in the atlas. These are placed the same way on both sides of the
+#display. Everything else, icons that are not in the atlas, and icons that have been modified since the atlas was built
+#are still rendered from the PNG file.
+#
+#Build (or rebuild after changing icons) with:
+#    python buildatlas.py
+#
+#File format (all numbers little-endian):
+#    header: magic "INKATLS1", width (uint16), height (uint16), number of icons (uint32)
+#    index:  per icon: length of the file name (uint16), file name (utf-8), mtime of the icon (double)
+#    data:   per icon in index order: normal payload, inverted payload (width*height/8 bytes each)
+
+import os
+import mmap
+import struct
+
+atlasMagic = b"INKATLS1"
+atlasHeader = struct.Struct("<8sHHI")
+atlasName = struct.Struct("<H")
+atlasMtime = struct.Struct("<d")
+defaultAtlasPath = "icons/icons.atlas"
+
+class IconAtlas:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        tag, self.w, self.h, count = atlasHeader.unpack_from(self.mmap, 0)
+        if tag != atlasMagic:
+            raise ValueError("Not an icon atlas: " + path)
+        self.size = self.w * self.h // 8   #Size of one payload
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.entries = {}   #Absolute path of the icon to (mtime, offset of its normal payload)
+        offset = atlasHeader.size
+        index = []
+        for i in range(count):
+            n, = atlasName.unpack_from(self.mmap, offset)
+            name = bytes(self.mmap[offset+atlasName.size:offset+atlasName.size+n]).decode("utf-8")
+            offset += atlasName.size + n
+            mtime, = atlasMtime.unpack_from(self.mmap, offset)
+            offset += atlasMtime.size
+            index.append((name, mtime))
+        for i, (name, mtime) in enumerate(index):
+            self.entries[os.path.join(self.directory, name)] = (mtime, offset + 2*i*self.size)
+        if offset + 2*count*self.size > len(self.mmap):
+            raise ValueError("Icon atlas is truncated: " + path)
+        self.hits = 0
+        self.misses = 0
+
+    #Returns the payload for an icon as memoryview or None if the atlas does not have it in this size or if the icon
+    #file has been modified since the atlas was built (mtime as returned by os.path.getmtime)
+    def get(self, icon, mtime, w, h, inverted=False):
+        entry = self.entries.get(os.path.abspath(icon)) if (w, h) == (self.w, self.h) else None
+        if entry == None or entry[0] != mtime:
+            self.misses += 1
+            return None
+        self.hits += 1
+        offset = entry[1] + (self.size if inverted else 0)
+        return self.view[offset:offset+self.size]
+
+    def stats(self):
+        return {"icons": len(self.entries), "width": self.w, "height": self.h, "hits": self.hits, "misses": self.misses}
+
+atlases = {} #Path to the loaded IconAtlas or None if it does not exist or cannot be read, shared by all devices
+
+def loadAtlas(path):
+    if path not in atlases:
+        try:
+            atlases[path] = IconAtlas(path)
+        except (OSError, ValueError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("Could not load icon atlas " + path + ": ", e)
+            atlases[path] = None
+    return atlases[path]
+
+#Renders all PNG files in a directory with Device.renderIcon for the button area of a display of the given size and
+#writes the atlas. The file is replaced atomically, so a running controller that has the old one mapped is not affected.
+def buildAtlas(directory, path=None, dispW=128, dispH=296):
+    from .device import Device
+    if path == None:
+        path = os.path.join(directory, "icons.atlas")
+    device = Device()
+    device.dispW, device.dispH = dispW, dispH
+    x, y, w, h = device.getAreaFor(2)
+    index = bytearray()
+    data = bytearray()
+    count = 0
+    for name in sorted(os.listdir(directory)):
+        icon = os.path.join(directory, name)
+        if not name.lower().endswith(".png") or not os.path.isfile(icon):
+            continue
+        try:
+            mtime = os.path.getmtime(icon)
+            payloads = [device.renderIcon(2, icon, w, h, inverted, True, False, False).convert("1").rotate(180).tobytes() for inverted in (False, True)]
+        except Exception as e:
+            print("Skipping " + icon + ": ", e)
+            continue
+        encodedName = os.path.relpath(icon, os.path.dirname(os.path.abspath(path))).encode("utf-8")
+        index += atlasName.pack(len(encodedName)) + encodedName + atlasMtime.pack(mtime)
+        for payload in payloads:
+            data += payload
+        count += 1
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(atlasHeader.pack(atlasMagic, w, h, count))
+        f.write(index)
+        f.write(data)
+    os.replace(tmp, path)
+    atlases.pop(path, None)
+    return count
@@ -0,0 +1,36 @@
+from collections import OrderedDict
+from threading import Lock
+
+#A bounded cache that drops the least recently used entry when it is full. It counts hits and misses, so the
+#effectiveness of the cache can be checked with stats().
+class LRUCache:
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    #Returns the cached value or None if the key is not in the cache
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
@@ -1,14 +1,118 @@
 from .protocol import *
-import serial
+from .cache import LRUCache
+from .metrics import metrics
+from .snapshot import ModeSnapshot
+from .leds import LedEngine
+from .atlas import loadAtlas, defaultAtlasPath
+import os
 import time
-from threading import Lock
-from PIL import Image, ImageDraw, ImageOps, ImageFont
+import queue
+import functools
+from threading import Lock, Thread
+from collections import deque
+#PIL and pyserial are only imported when they are needed (see loadFont, renderText, renderIcon and connect), so
+#importing inkkeys is fast and the controller can talk to the device as early as possible.
+
+#Splits the incoming byte stream into lines. New data is only scanned once for line breaks, so a long burst of
+#input (like a fast spin of the jog wheel) costs linear time instead of re-splitting the whole buffer each time.
+class LineSplitter:
+    def __init__(self):
+        self.partial = b""      #Incomplete line at the end of the data received so far
+        self.lines = []         #Complete lines that have not been read yet
+        self.nextLine = 0       #Index of the next line to be returned from self.lines
+
+    def feed(self, data):
+        if b"\n" not in data:
+            self.partial += data
+            return
+        chunks = (self.partial + data).split(b"\n")
+        self.partial = chunks.pop()
+        if self.nextLine >= len(self.lines):
+            self.lines = []
+            self.nextLine = 0
+        self.lines.extend(chunk.decode(errors="replace").replace("\r", "") for chunk in chunks)
+
+    def readLine(self):
+        if self.nextLine >= len(self.lines):
+            return None
+        line = self.lines[self.nextLine]
+        self.nextLine += 1
+        return line
+
+#Lines sent by the device when a key is pressed or released
+keyLines = {k.value for k in KeyCode if k not in (KeyCode.JOG, KeyCode.JOG_CW, KeyCode.JOG_CCW)}
+
+#Event tuples for all key lines and the usual jog wheel steps, so most lines are parsed with a single lookup
+eventTable = {line: (line, None) for line in keyLines}
+for steps in range(-64, 65):
+    eventTable[KeyCode.JOG.value + str(steps)] = (KeyCode.JOG.value, steps)
+
+#Turns a line received from the device into an event tuple (callback key, value) if it reports a key press or
+#a jog wheel rotation. Anything else (responses like "ok", info lines or errors) returns None.
+def parseEvent(line):
+    event = eventTable.get(line)
+    if event == None and len(line) > 1 and line[0] == KeyCode.JOG.value and (line[2:] if line[1] in "+-" else line[1:]).isdecimal():
+        return (KeyCode.JOG.value, int(line[1:]))
+    return event
+
+#Sums up consecutive jog events, so a fast spin of the jog wheel results in a single callback instead of a long queue
+#of them. Takes a list of (event, time received) tuples and returns a list of (event, first received, last received,
+#number of combined events).
+def coalesceEvents(items):
+    result = []
+    for event, received in items:
+        if event[0] == KeyCode.JOG.value and len(result) > 0 and result[-1][0][0] == KeyCode.JOG.value:
+            previous, first, last, count = result[-1]
+            result[-1] = ((KeyCode.JOG.value, previous[1] + event[1]), first, received, count + 1)
+        else:
+            result.append((event, received, received, 1))
+    return result
+
+commandNames = {code.value: code.name for code in CommandCode}
+
+sentBytesMetric = metrics.counter("inkkeys_sent_bytes_total", "Bytes sent to the device, by command")
+sentCommandsMetric = metrics.counter("inkkeys_sent_commands_total", "Commands sent to the device, by command")
+refreshMetric = metrics.histogram("inkkeys_refresh_seconds", "Duration of updateDisplay, split into the refresh and the resend of the image data")
+keyDispatchMetric = metrics.histogram("inkkeys_key_dispatch_seconds", "Time from receiving a key or jog event until its callback is called (with reader thread only)")
+
+fonts = {} #Fonts are only loaded once per process
+
+def loadFont(path, size):
+    if (path, size) not in fonts:
+        from PIL import ImageFont
+        fonts[(path, size)] = ImageFont.truetype(path, size)
+    return fonts[(path, size)]
+
+#Marks the methods of Device that change the state of the device. While a mode is recorded (see activateMode), each
+#call of such a method is added to the snapshot. Calls the method makes itself (i.e. setLeds calling sendLed) are not
+#recorded, because replaying the outer call makes them again.
+def recorded(method):
+    name = method.__name__
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        recording = self.recording
+        if recording == None:
+            return method(self, *args, **kwargs)
+        recording.record(name, args, kwargs)
+        self.recording = None
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.recording = recording
+    return wrapper
 
 class Device:
     ser = None
-    inbuffer = ""
+    inbuffer = None         #LineSplitter for input read directly from self.ser if no reader thread is used
 
-    awaitingResponseLock = Lock()
+    threadedInput = False   #If True, connect() starts a reader thread that owns self.ser and queues incoming events
+    readerThread = None
+    readerRunning = False
+    readerError = None      #Exception that stopped the reader thread, re-raised in the main thread by poll()
+    eventQueue = None       #Key and jog events from the reader thread with the time they were received
+    responseQueue = None    #Everything else from the reader thread (responses to commands)
+
+    awaitingResponseLock = None #Held while waiting for a response, so poll() does not take it from us
 
     testmode = False
     nLeds = 0
@@ -19,18 +123,71 @@ class Device:
 
     bannerHeight = 12 #Defines the height of top and bottom banner
 
-    imageBuffer = []
+    imageBuffer = None      #Encoded display commands since the last refresh, which are sent again after the refresh
+    maxImageBuffer = 32     #Regions in imageBuffer above which they are merged (exceeded if the mirror cannot merge them)
+
+    refreshDelay = 0.1          #Wait until no refresh has been requested for this long (in seconds)...
+    maxRefreshDelay = 0.5       #...but not longer than this after the first request, then do a single refresh for all requests
+    maxPartialRefreshes = 10    #Do a full refresh (against ghosting) after this many partial refreshes...
+    maxPartialRefreshTime = 600 #...or if the last full refresh is longer ago than this (in seconds)
+    refreshRequested = None     #Time of the first refresh request that has not been handled yet
+    lastRefreshRequest = None   #Time of the latest refresh request
+    fullRefreshRequested = False
+    partialRefreshCount = 0     #Partial refreshes since the last full refresh
+    lastFullRefresh = 0
+    refreshHistory = None       #Start times and durations of the refreshes in the last minute
+    refreshCount = 0
+    refreshTime = 0             #Total time spent in updateDisplay
+
+    iconCache = LRUCache(256) #Rendered icons as packed payloads, shared by all devices
+    iconAtlas = defaultAtlasPath #Prebuilt icon atlas (see atlas.py), used for plain icons if it exists. None to disable.
+    labelCache = LRUCache(256) #Rendered text labels as packed payloads, shared by all devices
+
+    framebuffer = None      #Packed 1-bit mirror of the display content in device coordinates (dispW/8 bytes per row)
+    framebufferKnown = None #One byte per byte of the mirror, 1 if the content of the mirror is known to be on the display
+
+    callbacks = None #This object stores callback functions that react directly to a keypress reported via serial
 
-    callbacks = {} #This object stores callback functions that react directly to a keypress reported via serial
+    jogTimeout = 0.5        #Jog events further apart than this start a new rotation (jogVelocity is 0)
+    jogMinWindow = 0.02     #Shortest time jogVelocity is measured over, so events received at once do not give absurd rates
+    lastJog = None          #Time the last jog event has been received
+    jogElapsed = 0          #Time between the first and the last step of the current jog callback (in seconds)
+    jogVelocity = 0         #Steps per second of the current jog callback
 
-    ledState = None         #Current LED status, so we can animate them over time
-    ledTime = None          #Last time LEDs were set
+    assignments = None      #Key to the last ASSIGN command sent for it, so unchanged assignments are not sent again
+    restoreState = True     #After reconnecting, send the last known display content, key assignments and LEDs again
+
+    snapshots = None        #Recorded activations of modes that allow it (see activateMode)
+    recording = None        #ModeSnapshot that is being recorded
+
+    ledEngine = None        #LedEngine with the current LED state, so we can animate them over time
 
     debug = False;
 
+    bufferWrites = False    #If True, commands are collected and written at once by flush() (at the latest before waiting for a response)
+    outbuffer = None        #Data that has not been written to the serial port yet
+    pendingCommands = 0     #Number of commands in outbuffer
+    lastCommand = None      #Name of the last command sent
+    txFlushes = 0           #Statistics: Number of writes to the serial port...
+    txBytes = 0             #...bytes written...
+    txCommands = 0          #...and commands written
+    lastFlushBytes = 0
+    lastFlushCommands = 0
+
+    #Mutable state is created for each instance, so several devices can be used at once. Only the render caches
+    #(iconCache and labelCache) are shared.
+    def __init__(self):
+        self.awaitingResponseLock = Lock()
+        self.imageBuffer = []
+        self.callbacks = {}
+
     def connect(self, dev):
+        import serial
         print("Connecting to ", dev, ".")
         self.ser = serial.Serial(dev, 115200, timeout=1)
+        self.inbuffer = LineSplitter()
+        if self.threadedInput:
+            self.startReaderThread()
         if not self.requestInfo(3):
             self.disconnect()
             return False
@@ -41,58 +198,283 @@ class Device:
         return True
 
     def disconnect(self):
+        self.stopReaderThread()
+        self.outbuffer = None
+        self.pendingCommands = 0
         if self.ser != None:
             self.ser.close()
             self.ser = None
 
+    def startReaderThread(self):
+        self.eventQueue = queue.Queue()
+        self.responseQueue = queue.Queue()
+        self.readerError = None
+        self.readerRunning = True
+        self.readerThread = Thread(target=self.readerLoop, name="inkkeys-reader", daemon=True)
+        self.readerThread.start()
+
+    def stopReaderThread(self):
+        if self.readerThread == None:
+            return
+        self.readerRunning = False
+        if self.readerThread.is_alive():
+            self.readerThread.join(2*self.ser.timeout if self.ser.timeout else None) #The thread notices the flag at the latest after a read timed out
+        self.readerThread = None
+
+    #Runs in the reader thread. Blocks on the serial port and sorts every complete line either into the event queue
+    #(keys and jog wheel) or the response queue (everything else, like "ok" or the device info).
+    def readerLoop(self):
+        splitter = LineSplitter()
+        try:
+            while self.readerRunning:
+                data = self.ser.read(max(1, self.ser.in_waiting))
+                if len(data) == 0:
+                    continue
+                splitter.feed(data)
+                line = splitter.readLine()
+                while line != None:
+                    if self.debug:
+                        print("Received: " + line)
+                    event = parseEvent(line)
+                    if event != None:
+                        self.eventQueue.put((event, time.time()))
+                    else:
+                        self.responseQueue.put(line)
+                    line = splitter.readLine()
+        except Exception as e:
+            if self.readerRunning:
+                self.readerError = e
+        finally:
+            self.readerRunning = False
+            self.eventQueue.put(None) #Wake up poll() so it can report the error
+
+    @recorded
     def sendToDevice(self, command):
         if self.debug:
             print("Sending: " + command)
-        self.ser.write((command + "\n").encode())
+        self.transmit((command + "\n").encode(), True)
 
+    @recorded
     def sendBinaryToDevice(self, data):
         if self.debug:
             print("Sending " + str(len(data)) + " bytes of binary data.")
-        self.ser.write(data)
-
-    def readFromDevice(self):
+        self.transmit(data, False)
+
+    #Writes to the serial port right away or, if bufferWrites is set, collects everything until flush() is called
+    def transmit(self, data, isCommand):
+        if self.outbuffer == None:
+            self.outbuffer = bytearray()
+        self.outbuffer += data
+        if isCommand:
+            self.pendingCommands += 1
+            self.lastCommand = commandNames.get(chr(data[0]), "UNKNOWN")
+            sentCommandsMetric.inc(command=self.lastCommand)
+        sentBytesMetric.inc(len(data), command=self.lastCommand) #Binary data is counted for the command it belongs to
+        if not self.bufferWrites:
+            self.flush()
+
+    #Writes everything collected so far with a single write
+    def flush(self):
+        if self.outbuffer == None or len(self.outbuffer) == 0:
+            return
+        self.ser.write(self.outbuffer)
+        self.countFlush()
+
+    def countFlush(self):
+        self.lastFlushBytes = len(self.outbuffer)
+        self.lastFlushCommands = self.pendingCommands
+        self.txFlushes += 1
+        self.txBytes += self.lastFlushBytes
+        self.txCommands += self.lastFlushCommands
+        if self.debug and self.bufferWrites:
+            print("Flushed " + str(self.lastFlushBytes) + " bytes (" + str(self.lastFlushCommands) + " commands) with one write.")
+        self.outbuffer = bytearray()
+        self.pendingCommands = 0
+
+    def transmitStats(self):
+        return {
+            "writes": self.txFlushes,
+            "bytes": self.txBytes,
+            "commands": self.txCommands,
+            "bytesPerWrite": self.txBytes / self.txFlushes if self.txFlushes > 0 else 0,
+            "commandsPerWrite": self.txCommands / self.txFlushes if self.txFlushes > 0 else 0,
+            "lastFlushBytes": self.lastFlushBytes,
+            "lastFlushCommands": self.lastFlushCommands,
+        }
+
+    #Returns the next line received from the device or None if there is none. If a timeout is given, waits up to
+    #timeout seconds for a line to arrive. With a reader thread, key events are not returned here but queued for poll().
+    def readFromDevice(self, timeout=0):
+        if self.readerThread != None:
+            try:
+                if timeout > 0:
+                    return self.responseQueue.get(timeout=timeout)
+                return self.responseQueue.get_nowait()
+            except queue.Empty:
+                if self.readerError != None:
+                    raise self.readerError
+                return None
+        line = self.readLineFromSerial()
+        if line == None and timeout > 0:
+            time.sleep(timeout)
+            line = self.readLineFromSerial()
+        return line
+
+    def readLineFromSerial(self):
         if self.ser.in_waiting > 0:
-            self.inbuffer += self.ser.read(self.ser.in_waiting).decode().replace("\r", "")
-        chunks = self.inbuffer.split("\n", 1)
-        if len(chunks) > 1:
-            cmd = chunks[0]
-            self.inbuffer = chunks[1]
-            if self.debug:
-                print("Received: " + cmd)
-            return cmd
-        return None
-
-    def poll(self):
-        with self.awaitingResponseLock:
-            input = self.readFromDevice()
-        if input != None:
-            if input[0] == KeyCode.JOG.value and (input[1:].isdecimal() or (input[1] == '-' and input[2:].isdecimal())):
-                if KeyCode.JOG.value in self.callbacks:
-                    self.callbacks[KeyCode.JOG.value](int(input[1:]))
-            elif input in self.callbacks:
-                self.callbacks[input]()
-
+            self.inbuffer.feed(self.ser.read(self.ser.in_waiting))
+        line = self.inbuffer.readLine()
+        if line != None and self.debug:
+            print("Received: " + line)
+        return line
+
+    #Calls the callbacks for a list of (event, time received) tuples. Consecutive jog events are combined into one
+    #callback with the total number of steps. Before calling a jog callback, jogElapsed is set to the time between the
+    #first and the last combined step and jogVelocity to the steps per second (0 for a single step that starts a
+    #rotation), so modes can scale the steps.
+    def dispatchEvents(self, items):
+        for event, first, last, count in coalesceEvents(items):
+            keyDispatchMetric.observe(time.time() - first)
+            if event[0] == KeyCode.JOG.value:
+                self.updateJog(event[1], first, last, count)
+            self.dispatchEvent(event)
+            self.flush() #Send whatever the callback wants to send right away
+
+    #The velocity of combined events is measured over their own timestamps. Only a single event is measured against
+    #the previous one, as long as that belongs to the same rotation.
+    def updateJog(self, steps, first, last, count=1):
+        if count > 1:
+            self.jogVelocity = steps / max(last - first, self.jogMinWindow)
+        elif self.lastJog != None and first - self.lastJog < self.jogTimeout:
+            self.jogVelocity = steps / max(last - self.lastJog, self.jogMinWindow)
+        else:
+            self.jogVelocity = 0
+        self.jogElapsed = last - first
+        self.lastJog = last
+
+    def dispatchEvent(self, event):
+        key, value = event
+        if key in self.callbacks:
+            if value == None:
+                self.callbacks[key]()
+            else:
+                self.callbacks[key](value)
+
+    #Handles key presses reported by the device by calling the registered callbacks.
+    #With a reader thread, this waits up to timeout seconds for events (or a call to wake()) and returns as soon as all
+    #queued events have been handled, so a key press is handled right away instead of after a sleep.
+    #Without a reader thread, everything that has been received is handled after sleeping for the timeout.
+    #Returns True if anything has been handled.
+    def poll(self, timeout=0):
+        items = []
+        if self.readerThread == None:
+            if timeout > 0:
+                time.sleep(timeout)
+            with self.awaitingResponseLock:
+                input = self.readFromDevice()
+                while input != None:
+                    event = parseEvent(input)
+                    if event != None:
+                        items.append((event, time.time()))
+                    input = self.readFromDevice()
+            self.dispatchEvents(items)
+            return len(items) > 0
+        deadline = time.time() + timeout
+        handled = False
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0 and not handled:
+                    item = self.eventQueue.get(timeout=remaining)
+                else:
+                    item = self.eventQueue.get_nowait()
+            except queue.Empty:
+                self.dispatchEvents(items)
+                return handled
+            if item == None:
+                self.dispatchEvents(items)
+                import serial
+                raise self.readerError if self.readerError != None else serial.SerialException("Reader thread stopped.")
+            handled = True
+            if item[0] != None: #Otherwise woken up by wake()
+                items.append(item)
+
+    #Makes a waiting poll() return early, i.e. if another thread has something for the main loop to do.
+    #Only has an effect with the reader thread.
+    def wake(self):
+        if self.readerThread != None:
+            self.eventQueue.put((None, time.time()))
+
+    @recorded
     def registerCallback(self, cb, key):
         self.callbacks[key.value] = cb
 
+    @recorded
     def clearCallback(self, key):
         if key.value in self.callbacks:
             del self.callbacks[key.value]
 
+    @recorded
     def clearCallbacks(self):
         self.callbacks = {}
 
-    def assignKey(self, key, sequence):
-        self.sendToDevice(CommandCode.ASSIGN.value + " " + key.value + (" " + " ".join(sequence) if len(sequence) > 0 else ""))
+    #Sends a command that has already been encoded (including the line break), i.e. one from compileAssign
+    @recorded
+    def sendCompiled(self, command):
+        if self.debug:
+            print("Sending: " + command[:-1].decode())
+        self.transmit(command, True)
 
+    #Assigns a sequence of events to a key. The sequence can be a list of events or compiled with compileSequence.
+    #Nothing is sent if the device already has this assignment.
+    def assignKey(self, key, sequence):
+        self.assignCompiled(key, compileAssign(key, sequence))
+
+    #Same as assignKey, but with the complete command from compileAssign. This is what snapshots record, so replaying
+    #them does not encode the sequences again.
+    @recorded
+    def assignCompiled(self, key, command):
+        if self.assignments == None:
+            self.assignments = {}
+        elif self.assignments.get(key.value) == command:
+            if self.debug:
+                print("Skipping unchanged assignment: " + command[:-1].decode())
+            return
+        self.assignments[key.value] = command
+        self.sendCompiled(command)
+
+    #Assigns several keys at once from a dictionary of keys to sequences. Only changed assignments are sent.
+    def assignKeys(self, assignments):
+        for key, sequence in assignments.items():
+            self.assignKey(key, sequence)
+
+    #Calls the activate function of a mode. Modes with "snapshot = True" promise that activate only calls methods of
+    #the device (and always the same ones), so the first activation is recorded and later activations just replay the
+    #recorded calls (see recorded) without rendering anything. A mode can set "changed = True"
+    #to be recorded again. Recordings are also dropped if an icon file changes.
+    def activateMode(self, mode):
+        if not getattr(mode, "snapshot", False):
+            mode.activate(self)
+            return
+        if self.snapshots == None:
+            self.snapshots = {}
+        snapshot = self.snapshots.get(mode)
+        if snapshot != None and not getattr(mode, "changed", False) and snapshot.isValidFor(self):
+            snapshot.replay(self)
+            return
+        mode.changed = False
+        self.recording = ModeSnapshot(self.dispW, self.dispH)
+        try:
+            mode.activate(self)
+            self.snapshots[mode] = self.recording
+        finally:
+            self.recording = None
+
+    @recorded
     def sendLed(self, colors):
         self.sendToDevice(CommandCode.LED.value + " " + " ".join(colors))
 
+    @recorded
     def sendLedAnimation(self, animation, steps, delay=0, brightness=0, g=0, r=0, b=0, iteration=1, lednumber = 0):
         self.sendToDevice(f"{CommandCode.ANIMATE.value} {animation} {steps} {delay} {brightness} {g} {r} {b} {iteration} {lednumber}")
 
@@ -101,13 +483,13 @@ class Device:
             print("Requesting device info...")
             start = time.time()
             self.sendToDevice(CommandCode.INFO.value)
+            self.flush()
             line = self.readFromDevice()
             while line != "Inkkeys":
                 if time.time() - start > timeout:
                     return False
                 if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
+                    line = self.readFromDevice(0.1)
                     continue
                 print("Skipping: ", line)
                 line = self.readFromDevice()
@@ -117,73 +499,309 @@ class Device:
                 if time.time() - start > timeout:
                     return False
                 if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
+                    line = self.readFromDevice(0.1)
                     continue
-                if line.startswith("TEST "):
-                    self.testmode = line[5] != "0"
-                elif line.startswith("N_LED "):
-                    self.nLeds = int(line[6:])
-                elif line.startswith("DISP_W "):
-                    self.dispW = int(line[7:])
-                elif line.startswith("DISP_H "):
-                    self.dispH = int(line[7:])
-                elif line.startswith("ROT_CIRCLE_STEPS "):
-                    self.rotCircleSteps = int(line[17:])
-                else:
-                    print("Skipping: ", line)
+                self.parseInfoLine(line)
                 line = self.readFromDevice()
-            print("End of info received.")
-            print("Testmode: ", self.testmode)
-            print("Number of LEDs: ", self.nLeds)
-            print("Display width: ", self.dispW)
-            print("Display height: ", self.dispH)
-            print("Rotation circle steps: ", self.rotCircleSteps)
+            self.printInfo()
+            self.restoreDeviceState()
             return True
 
+    #Called after (re)connecting. If we have been connected to this device before, the last known display content and
+    #key assignments are sent again as they are (already encoded and packed), so the device is usable right away and
+    #the next activation of a mode only sends what actually changed. LEDs are sent again with the next frame.
+    def restoreDeviceState(self):
+        framebuffer, known, assignments = self.framebuffer, self.framebufferKnown, self.assignments
+        self.resetDeviceState()
+        if not self.restoreState or framebuffer == None or len(framebuffer) != len(self.framebuffer):
+            return False
+        for command in (assignments or {}).values():
+            self.sendCompiled(command)
+        self.assignments = dict(assignments or {})
+        stride = self.dispW//8
+        rows = [y for y in range(self.dispH) if any(known[y*stride:(y+1)*stride])]
+        columns = [c for c in range(stride) if any(known[c::stride])]
+        if len(rows) > 0:
+            x, y, w, h = columns[0]*8, rows[0], (columns[-1] - columns[0] + 1)*8, rows[-1] - rows[0] + 1
+            data = bytes(framebuffer[i] if known[i] else 0xff for row in range(y, y + h) for i in range(row*stride + x//8, row*stride + (x + w)//8)) #The firmware clears the display to white, so unknown parts are white
+            self.sendImageData(x, y, w, h, data)
+            self.requestRefresh(True)
+        return True
+
+    #Forgets everything we know about the state of the device. Image data and refresh requests from before the
+    #disconnect are dropped as well, so they are neither resent nor refreshed on the new connection.
+    def resetDeviceState(self):
+        self.resetFramebuffer()
+        self.imageBuffer = []
+        self.refreshRequested = None
+        self.lastRefreshRequest = None
+        self.fullRefreshRequested = False
+        self.partialRefreshCount = 0
+        self.lastFullRefresh = 0 #We do not know what happened to the display before, so the next refresh should be a full one
+        self.assignments = {}
+        if self.ledEngine != None:
+            self.ledEngine.invalidate()
+
+    def parseInfoLine(self, line):
+        if line.startswith("TEST "):
+            self.testmode = line[5] != "0"
+        elif line.startswith("N_LED "):
+            self.nLeds = int(line[6:])
+        elif line.startswith("DISP_W "):
+            self.dispW = int(line[7:])
+        elif line.startswith("DISP_H "):
+            self.dispH = int(line[7:])
+        elif line.startswith("ROT_CIRCLE_STEPS "):
+            self.rotCircleSteps = int(line[17:])
+        else:
+            print("Skipping: ", line)
+
+    def printInfo(self):
+        print("End of info received.")
+        print("Testmode: ", self.testmode)
+        print("Number of LEDs: ", self.nLeds)
+        print("Display width: ", self.dispW)
+        print("Display height: ", self.dispH)
+        print("Rotation circle steps: ", self.rotCircleSteps)
+
     def sendImage(self, x, y, image):
-        self.imageBuffer.append({"x": x, "y": y, "image": image.copy()})
         w, h = image.size
         data = image.convert("1").rotate(180).tobytes()
-        self.sendToDevice(CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h))
-        self.sendBinaryToDevice(data)
+        return self.sendImageData(x, y, w, h, data)
+
+    #Sends packed 1-bit image data (rows of w/8 bytes, already rotated to the device orientation) to the display.
+    #Only the part that differs from what is already on the display is sent, or nothing at all if it is unchanged.
+    @recorded
+    def sendImageData(self, x, y, w, h, data):
+        region = self.changedRegion(x, y, w, h, data)
+        if region == None:
+            if self.debug:
+                print("Skipping unchanged image at " + str((x, y, w, h)) + ".")
+            return True
+        x, y, w, h, data = region
+        self.updateFramebuffer(x, y, w, h, data)
+        encoded = (CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h) + "\n").encode() + data
+        self.bufferImageData(x, y, w, h, encoded)
+        if self.debug:
+            print("Sending: " + CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h) + " (" + str(len(data)) + " bytes of binary data)")
+        self.transmit(encoded, True)
         return True
 
+    #Keeps the encoded command for the resend after the next refresh. Older regions that are completely covered by the
+    #new one are dropped and if there are still too many regions, they are merged into one from the framebuffer mirror.
+    #Regions are never dropped otherwise, as the resend has to cover everything that has been sent.
+    def bufferImageData(self, x, y, w, h, encoded):
+        self.imageBuffer = [part for part in self.imageBuffer if not (x <= part["x"] and y <= part["y"] and part["x"] + part["w"] <= x + w and part["y"] + part["h"] <= y + h)]
+        self.imageBuffer.append({"x": x, "y": y, "w": w, "h": h, "encoded": encoded})
+        if len(self.imageBuffer) > self.maxImageBuffer:
+            self.mergeImageBuffer()
+
+    #Merges regions until the image buffer is small enough again. The merged region is taken from the framebuffer
+    #mirror, which always holds the final content, so it can be placed after all other regions.
+    def mergeImageBuffer(self):
+        while len(self.imageBuffer) > self.maxImageBuffer:
+            pair = None
+            merged = None
+            for i in range(len(self.imageBuffer)):
+                for j in range(len(self.imageBuffer)-1, i, -1):
+                    merged = self.mergedRegion([self.imageBuffer[i], self.imageBuffer[j]])
+                    if merged != None:
+                        pair = (i, j)
+                        break
+                if pair != None:
+                    break
+            if pair == None:
+                #The mirror does not know the area between any of the regions, so we cannot merge. The regions have
+                #already been sent and have to be sent again after the refresh, so we keep all of them and the limit is
+                #exceeded until the next refresh.
+                if self.debug:
+                    print("Image buffer full, but no regions can be merged. Keeping " + str(len(self.imageBuffer)) + " regions.")
+                break
+            self.imageBuffer = [part for k, part in enumerate(self.imageBuffer) if k not in pair]
+            self.bufferImageData(*merged)
+
+    def mergedRegion(self, parts):
+        x = min(part["x"] for part in parts) // 8 * 8
+        y = min(part["y"] for part in parts)
+        w = (max(part["x"] + part["w"] for part in parts) + 7) // 8 * 8 - x
+        h = max(part["y"] + part["h"] for part in parts) - y
+        data = self.framebufferRegion(x, y, w, h)
+        if data == None:
+            return None
+        return (x, y, w, h, (CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h) + "\n").encode() + data)
+
     def resendImageData(self):
         for part in self.imageBuffer:
-            image = part["image"]
-            x = part["x"]
-            y = part["y"]
-            w, h = image.size
-            data = image.convert("1").rotate(180).tobytes()
-            self.sendToDevice(CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h))
-            self.sendBinaryToDevice(data)
+            if self.debug:
+                print("Resending image at " + str((part["x"], part["y"], part["w"], part["h"])) + ".")
+            self.transmit(part["encoded"], True)
         self.imageBuffer = []
 
+    def resetFramebuffer(self):
+        self.framebuffer = bytearray(self.dispW//8 * self.dispH)
+        self.framebufferKnown = bytearray(self.dispW//8 * self.dispH)
+
+    def framebufferCovers(self, x, y, w, h):
+        return self.framebuffer != None and x % 8 == 0 and w % 8 == 0 and x >= 0 and y >= 0 and x + w <= self.dispW and y + h <= self.dispH
+
+    #Compares image data with the framebuffer mirror and returns the smallest byte-aligned region (x, y, w, h, data)
+    #that contains all changes or None if nothing changed. Regions the mirror cannot track are returned unchanged.
+    def changedRegion(self, x, y, w, h, data):
+        if not self.framebufferCovers(x, y, w, h):
+            return (x, y, w, h, data)
+        stride = self.dispW // 8
+        bw = w // 8
+        allKnown = b"\x01" * bw
+        top = None
+        bottom = None
+        left = bw
+        right = -1
+        for row in range(h):
+            offset = (y + row) * stride + x // 8
+            new = data[row*bw:(row+1)*bw]
+            if self.framebuffer[offset:offset+bw] == new and self.framebufferKnown[offset:offset+bw] == allKnown:
+                continue
+            if top == None:
+                top = row
+            bottom = row
+            for i in range(left):
+                if self.framebuffer[offset+i] != new[i] or not self.framebufferKnown[offset+i]:
+                    left = i
+                    break
+            for i in range(bw-1, right, -1):
+                if self.framebuffer[offset+i] != new[i] or not self.framebufferKnown[offset+i]:
+                    right = i
+                    break
+        if top == None:
+            return None
+        if top == 0 and bottom == h-1 and left == 0 and right == bw-1:
+            return (x, y, w, h, data)
+        data = b"".join(data[row*bw+left:row*bw+right+1] for row in range(top, bottom+1))
+        return (x + 8*left, y + top, 8*(right-left+1), bottom-top+1, data)
+
+    #Returns the packed content of the mirror for a region or None if not all of it is known
+    def framebufferRegion(self, x, y, w, h):
+        if not self.framebufferCovers(x, y, w, h):
+            return None
+        stride = self.dispW // 8
+        bw = w // 8
+        data = bytearray()
+        for row in range(h):
+            offset = (y + row) * stride + x // 8
+            if self.framebufferKnown[offset:offset+bw] != b"\x01" * bw:
+                return None
+            data += self.framebuffer[offset:offset+bw]
+        return bytes(data)
+
+    def updateFramebuffer(self, x, y, w, h, data):
+        if self.framebuffer == None:
+            return
+        stride = self.dispW // 8
+        if not self.framebufferCovers(x, y, w, h):
+            #We cannot track this region (not byte-aligned or outside the display), so forget what we know about it
+            for row in range(max(0, y), min(self.dispH, y + h)):
+                start = row * stride + max(0, x) // 8
+                end = row * stride + min(self.dispW, x + w + 7) // 8
+                self.framebufferKnown[start:end] = bytes(max(0, end - start))
+            return
+        bw = w // 8
+        for row in range(h):
+            offset = (y + row) * stride + x // 8
+            self.framebuffer[offset:offset+bw] = data[row*bw:(row+1)*bw]
+            self.framebufferKnown[offset:offset+bw] = b"\x01" * bw
+
+    #Marks the display as changed, so it will be refreshed by refreshIfDue(). Use this instead of calling updateDisplay()
+    #directly, so several changes in quick succession only lead to a single refresh.
+    @recorded
+    def requestRefresh(self, full=False):
+        now = time.time()
+        if self.refreshRequested == None:
+            self.refreshRequested = now
+        self.lastRefreshRequest = now
+        self.fullRefreshRequested = self.fullRefreshRequested or full
+
+    #Returns None if no refresh is due, otherwise whether the due refresh should be a full refresh
+    def dueRefresh(self):
+        if self.refreshRequested == None:
+            return None
+        now = time.time()
+        if now - self.lastRefreshRequest < self.refreshDelay and now - self.refreshRequested < self.maxRefreshDelay:
+            return None
+        full = self.fullRefreshRequested
+        self.refreshRequested = None
+        self.fullRefreshRequested = False
+        if not full and len(self.imageBuffer) == 0:
+            return None #Nothing has changed on the display since the last refresh
+        return full or self.partialRefreshCount >= self.maxPartialRefreshes or now - self.lastFullRefresh > self.maxPartialRefreshTime
+
+    #Returns the time at which refreshIfDue() will refresh the display or None if no refresh has been requested
+    def refreshDeadline(self):
+        if self.refreshRequested == None:
+            return None
+        return min(self.lastRefreshRequest + self.refreshDelay, self.refreshRequested + self.maxRefreshDelay)
+
+    #Has to be called regularly (i.e. from the main loop) to refresh the display if requested via requestRefresh()
+    def refreshIfDue(self):
+        full = self.dueRefresh()
+        if full == None:
+            return False
+        return self.updateDisplay(full)
+
+    def countRefresh(self, fullRefresh, start, refreshed):
+        now = time.time()
+        refreshMetric.observe(refreshed - start, phase="refresh", type=("full" if fullRefresh else "partial"))
+        refreshMetric.observe(now - refreshed, phase="resend")
+        if fullRefresh:
+            self.partialRefreshCount = 0
+            self.lastFullRefresh = now
+        else:
+            self.partialRefreshCount += 1
+        if self.refreshHistory == None:
+            self.refreshHistory = deque()
+        self.refreshHistory.append((start, now - start))
+        while self.refreshHistory[0][0] < now - 60:
+            self.refreshHistory.popleft()
+        self.refreshCount += 1
+        self.refreshTime += now - start
+
+    def refreshStats(self):
+        history = [] if self.refreshHistory == None else [entry for entry in self.refreshHistory if entry[0] >= time.time() - 60]
+        return {
+            "refreshes": self.refreshCount,
+            "refreshTime": self.refreshTime,
+            "refreshesPerMinute": len(history),
+            "refreshTimePerMinute": sum(duration for start, duration in history),
+            "partialRefreshesSinceFull": self.partialRefreshCount,
+        }
+
+    @recorded
     def updateDisplay(self, fullRefresh=True, timeout=5):
         with self.awaitingResponseLock:
             start = time.time()
             self.sendToDevice(CommandCode.REFRESH.value + " " + (RefreshTypeCode.FULL.value if fullRefresh else RefreshTypeCode.PARTIAL.value))
+            self.flush()
             line = self.readFromDevice()
             while line != "ok":
                 if time.time() - start > timeout:
                     return False
                 if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
+                    line = self.readFromDevice(0.1)
                     continue
                 line = self.readFromDevice()
+            refreshed = time.time()
             self.resendImageData()
             self.sendToDevice(CommandCode.REFRESH.value + " " + RefreshTypeCode.OFF.value)
+            self.flush()
             line = self.readFromDevice()
             while line != "ok":
                 if time.time() - start > timeout:
                     return False
                 if line == None:
-                    time.sleep(0.1)
-                    line = self.readFromDevice()
+                    line = self.readFromDevice(0.1)
                     continue
                 line = self.readFromDevice()
+            self.countRefresh(fullRefresh, start, refreshed)
+            return True
 
     def getAreaFor(self, function):
         if function == "title":
@@ -203,13 +821,23 @@ class Device:
             image = image.resize((w, h))
         self.sendImage(x, y, image)
 
+    #Labels are rendered once and then served from labelCache
     def sendTextFor(self, function, text, subtext="", inverted=False):
         x, y, w, h = self.getAreaFor(function)
+        key = (function, text, subtext, inverted, w, h)
+        data = self.labelCache.get(key)
+        if data == None:
+            data = self.renderText(function, text, subtext, w, h, inverted).convert("1").rotate(180).tobytes()
+            self.labelCache.put(key, data)
+        self.sendImageData(x, y, w, h, data)
+
+    def renderText(self, function, text, subtext, w, h, inverted):
+        from PIL import Image, ImageDraw
         img = Image.new("1", (w, h), color=(0 if inverted else 1))
         d = ImageDraw.Draw(img)
-        font1 = ImageFont.truetype("font/Munro.ttf", 10)
+        font1 = loadFont("font/Munro.ttf", 10)
         wt1, ht1 = font1.getsize(text);
-        font2 = ImageFont.truetype("font/MunroSmall.ttf", 10)
+        font2 = loadFont("font/MunroSmall.ttf", 10)
         wt2, ht2 = font2.getsize_multiline(subtext);
         if function == 1 or function == "title":
             position1 = ((w-wt1)/2,(h-ht1-(0.5 if function == "title" else 0))/2) #Center jog wheel and title label (the title get's small -0.5 nudge for rounding to prefer a top alignment)
@@ -227,10 +855,48 @@ class Device:
         d.text(position1, text, font=font1, fill=(1 if inverted else 0))
         if position2 != None and subtext != None:
             d.multiline_text(position2, subtext, font=font2, align=align, spacing=-2, fill=(1 if inverted else 0))
-        self.sendImageFor(function, img)
+        return img
 
+    #Plain icons are taken from the icon atlas if there is an up to date one. Other icons are rendered once and then
+    #served from iconCache until the icon file (or the marker) changes.
     def sendIconFor(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
         x, y, w, h = self.getAreaFor(function)
+        try:
+            mtime = os.path.getmtime(icon)
+        except OSError:
+            mtime = None
+        markerMtime = None
+        if marked:
+            marker = self.markerFor(function)
+            try:
+                markerMtime = os.path.getmtime(marker)
+            except OSError:
+                pass
+        if self.recording != None:
+            self.recording.recordFile(icon, mtime)
+            if marked:
+                self.recording.recordFile(marker, markerMtime)
+        data = None
+        if centered and not marked and not crossed and self.iconAtlas != None:
+            atlas = loadAtlas(self.iconAtlas)
+            if atlas != None:
+                data = atlas.get(icon, mtime, w, h, inverted) #Mapped payload, no need to render or cache anything
+        if data != None:
+            self.sendImageData(x, y, w, h, data)
+            return
+        key = (icon, mtime, w, h, function < 6, inverted, centered, marked, markerMtime, crossed)
+        data = self.iconCache.get(key)
+        if data == None:
+            data = self.renderIcon(function, icon, w, h, inverted, centered, marked, crossed).convert("1").rotate(180).tobytes()
+            self.iconCache.put(key, data)
+        self.sendImageData(x, y, w, h, data)
+
+    #Marker drawn next to an icon if it is marked, pointing towards the middle of the display
+    def markerFor(self, function):
+        return "icons/chevron-compact-right.png" if function < 6 else "icons/chevron-compact-left.png"
+
+    def renderIcon(self, function, icon, w, h, inverted, centered, marked, crossed):
+        from PIL import Image, ImageDraw, ImageOps
         img = Image.new("1", (w, h), color=(0 if inverted else 1))
         imgIcon = Image.open(icon).convert("RGB")
         if inverted:
@@ -243,7 +909,7 @@ class Device:
         img.paste(imgIcon, pos)
 
         if marked:
-            imgMarker = Image.open("icons/chevron-compact-right.png" if function < 6 else "icons/chevron-compact-left.png")
+            imgMarker = Image.open(self.markerFor(function))
             wm, hm = imgMarker.size
             img.paste(imgMarker, (-16,(h - hm)//2) if function < 6 else (w-wm+16,(h - hm)//2), mask=ImageOps.invert(imgMarker.convert("RGB")).convert("1"))
 
@@ -252,25 +918,44 @@ class Device:
             d.line([pos[0]+5, pos[1]+5, pos[0]+wi-5, pos[1]+hi-5], width=3)
             d.line([pos[0]+5, pos[1]+hi-5, pos[0]+wi-5, pos[1]+5], width=3)
 
-        self.sendImage(x, y, img)
-
-    def setLeds(self, leds):
-        ledStr = ['{:06x}'.format(i) for i in leds]
-        self.ledTime = time.time()
-        self.ledState = leds
-        self.sendLed(ledStr)
+        return img
+
+    def getLedEngine(self):
+        if self.ledEngine == None or self.ledEngine.nLeds != self.nLeds:
+            self.ledEngine = LedEngine(self.nLeds)
+        return self.ledEngine
+
+    #Sets the LEDs to the given colors (as 0xRRGGBB integers). By default, they stay on for 3 seconds and then fade out
+    #over 0.5 seconds if fadeLeds() is called regularly. The durations can be changed per call or per LED on the engine.
+    @recorded
+    def setLeds(self, leds, hold=None, fade=None):
+        now = time.time()
+        self.getLedEngine().set(leds, now, hold, fade)
+        self.updateLeds(now)
+
+    #Sends the current colors, but only if they differ from what the device already shows
+    def updateLeds(self, now):
+        colors = self.ledEngine.frame(now)
+        if colors != None:
+            self.sendLed(colors)
+
+    #Returns the time from which on fadeLeds() needs to be called for every frame or None if the LEDs are not fading
+    def ledDeadline(self):
+        if self.ledEngine == None:
+            return None
+        return self.ledEngine.deadline(time.time())
 
     def fadeLeds(self):
-        if self.ledState == None:
+        if self.ledEngine == None:
             return
-        p = (3.5 - (time.time() - self.ledTime))/0.5 #Stay on for 3 seconds and then fade out over 0.5 seconds
-        if p >= 1:
-            return
-        if p <= 0:
-            self.ledState = None
-            self.sendLed(["000000" for i in range(self.nLeds)])
-            return
-        dimmedLeds = [(int((i & 0xff0000) * p) & 0xff0000) | (int((i & 0xff00) * p) & 0xff00) | (int((i & 0xff) * p) & 0xff) for i in self.ledState]
-        ledStr = ['{:06x}'.format(i) for i in dimmedLeds]
-        self.sendLed(ledStr)
+        self.updateLeds(time.time())
+
+    def ledStats(self):
+        if self.ledEngine == None:
+            return None
+        return self.ledEngine.stats()
 
+metrics.gauge("inkkeys_icon_cache_hits", "Hits of the icon cache", lambda: Device.iconCache.hits)
+metrics.gauge("inkkeys_icon_cache_misses", "Misses of the icon cache", lambda: Device.iconCache.misses)
+metrics.gauge("inkkeys_label_cache_hits", "Hits of the label cache", lambda: Device.labelCache.hits)
+metrics.gauge("inkkeys_label_cache_misses", "Misses of the label cache", lambda: Device.labelCache.misses)
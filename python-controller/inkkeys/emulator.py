@@ -0,0 +1,257 @@
+#Emulates the inkkeys firmware (see arduino/inkkeys/serialinput.ino) on a pseudo-terminal, so the controller, modes
+#and benchmarks can be run without the physical device. Device.connect() can open the emulator's port like a real one.
+#Only works on platforms with pseudo-terminals (Linux, macOS).
+#
+#Usage:
+#    emulator = DeviceEmulator()
+#    emulator.start()
+#    device.connect(emulator.port)
+#    emulator.pressKey(2)
+#    emulator.saveImage("display.png")
+#
+#It can also be run on its own with "python -m inkkeys.emulator", which prints the port to connect to.
+
+from .protocol import *
+import os
+import time
+import tty
+import select
+from threading import Thread, Lock
+
+class DeviceEmulator:
+    dispW = 128
+    dispH = 296
+    nLeds = 20
+    rotCircleSteps = 64
+    testmode = False
+
+    baudrate = None             #If set, transfers in both directions are slowed down to this baud rate (10 bits per byte)
+    partialRefreshDelay = 0.0   #Simulated time a partial refresh takes (in seconds)
+    fullRefreshDelay = 0.0      #Simulated time a full refresh takes (in seconds)
+    serialBufferSize = 256      #Same as in the firmware. Longer commands are rejected.
+
+    def __init__(self, **settings):
+        for key, value in settings.items():
+            if not hasattr(self, key):
+                raise AttributeError("Unknown setting: " + key)
+            setattr(self, key, value)
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+        self.wakeRead = None    #Pipe to wake up the thread on stop()
+        self.wakeWrite = None
+        self.running = False
+        self.writeLock = Lock()
+        self.ram = bytearray(b"\xff" * (self.dispW//8 * self.dispH)) #Content written to the display controller
+        self.display = bytes(self.ram)                                  #Content visible after the last refresh
+        self.assignments = {}   #Key (i.e. "2p" or "R+") to list of events as sent by the controller
+        self.leds = [0] * self.nLeds
+        self.animations = []    #Parameters of all received animation commands
+        self.refreshes = []     #Refresh types ("p" or "f") in the order they were received
+        self.errors = []        #Error lines the firmware would have printed
+        self.commands = {}      #Number of received commands per command character
+        self.bytesReceived = 0
+        self.onRefresh = None   #Optional function called with the refresh type after every refresh
+        self.buffer = bytearray()
+        self.expectingImageData = 0
+        self.imageX = 0
+        self.imageY = 0
+        self.imageW = 0
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.running = True
+        self.thread = Thread(target=self.run, name="inkkeys-emulator", daemon=True)
+        self.thread.start()
+        return self.port
+
+    #Stops the emulator and closes the port, so the controller sees the device disappear like on unplugging it.
+    #The thread is woken up through a pipe and the file descriptors are only closed once it has exited.
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            os.write(self.wakeWrite, b"\0")
+            self.thread.join()
+            self.thread = None
+        with self.writeLock:
+            for fd in (self.slave, self.master, self.wakeRead, self.wakeWrite):
+                if fd != None:
+                    os.close(fd)
+            self.slave = None
+            self.master = None
+            self.wakeRead = None
+            self.wakeWrite = None
+
+    def run(self):
+        while self.running:
+            readable = select.select([self.master, self.wakeRead], [], [])[0]
+            if self.wakeRead in readable:
+                return
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if self.baudrate != None:
+                time.sleep(len(data) * 10 / self.baudrate)
+            self.bytesReceived += len(data)
+            self.receive(data)
+
+    def write(self, line):
+        data = (line + "\r\n").encode()
+        if self.baudrate != None:
+            time.sleep(len(data) * 10 / self.baudrate)
+        with self.writeLock:
+            if self.master != None:
+                os.write(self.master, data)
+
+    #Same logic as handleSerialInput() in the firmware, but for a chunk of data
+    def receive(self, data):
+        i = 0
+        while i < len(data):
+            if self.expectingImageData > 0:
+                rowBytes = (self.imageW + 7) // 8
+                n = min(self.expectingImageData, rowBytes - len(self.buffer), len(data) - i)
+                self.buffer += data[i:i+n]
+                i += n
+                self.expectingImageData -= n
+                if len(self.buffer) == rowBytes:
+                    self.writeRow(self.imageX, self.imageY, self.imageW, self.buffer)
+                    self.imageY += 1
+                    self.buffer = bytearray()
+                continue
+            c = data[i]
+            i += 1
+            if c == 0x0a:
+                if len(self.buffer) >= self.serialBufferSize:
+                    self.error("E: Command too long.")
+                elif len(self.buffer) > 0:
+                    self.process(self.buffer.decode(errors="replace"))
+                self.buffer = bytearray()
+            elif len(self.buffer) < self.serialBufferSize:
+                self.buffer.append(c)
+
+    def writeRow(self, x, y, w, row):
+        if y < 0 or y >= self.dispH:
+            return
+        stride = self.dispW // 8
+        for px in range(w):
+            tx = x + px
+            if tx < 0 or tx >= self.dispW:
+                continue
+            bit = (row[px // 8] >> (7 - px % 8)) & 1
+            index = y * stride + tx // 8
+            mask = 0x80 >> (tx % 8)
+            if bit:
+                self.ram[index] |= mask
+            else:
+                self.ram[index] &= ~mask
+
+    def error(self, line):
+        self.errors.append(line)
+        self.write(line)
+
+    def process(self, command):
+        self.commands[command[0]] = self.commands.get(command[0], 0) + 1
+        if command[0] == CommandCode.ASSIGN.value:
+            self.processAssign(command)
+        elif command[0] == CommandCode.DISPLAY.value:
+            self.processDisplay(command)
+        elif command[0] == CommandCode.INFO.value:
+            self.processInfo(command)
+        elif command[0] == CommandCode.LED.value:
+            self.processLed(command)
+        elif command[0] == CommandCode.ANIMATE.value:
+            self.animations.append(command[2:].split(" "))
+        elif command[0] == CommandCode.REFRESH.value:
+            self.processRefresh(command)
+        else:
+            self.error("E: Unknown command: " + command)
+
+    def processAssign(self, command):
+        parts = command.split(" ")
+        if len(command) < 4 or command[1] != " " or len(parts[1]) != 2 or parts[1][0] not in "123456789R" or parts[1][1] not in "pr+-":
+            self.error("E: Bad format")
+            return
+        self.assignments[parts[1]] = parts[2:]
+
+    def processDisplay(self, command):
+        try:
+            x, y, w, h = [int(v) for v in command[2:].split(" ")]
+        except ValueError:
+            self.error("E: Bad format.")
+            return
+        self.imageX = x
+        self.imageY = y
+        self.imageW = w
+        self.expectingImageData = w * h // 8
+        self.buffer = bytearray()
+
+    def processInfo(self, command):
+        if len(command) > 1:
+            self.error("E: Bad format.")
+            return
+        self.write("Inkkeys")
+        self.write("TEST " + ("1" if self.testmode else "0"))
+        self.write("N_LED " + str(self.nLeds))
+        self.write("DISP_W " + str(self.dispW))
+        self.write("DISP_H " + str(self.dispH))
+        self.write("ROT_CIRCLE_STEPS " + str(self.rotCircleSteps))
+        self.write("Done")
+
+    def processLed(self, command):
+        if len(command) != 7*self.nLeds+1:
+            self.error("E: Bad format.")
+            return
+        self.leds = [int(command[7*i+2:7*i+8], 16) for i in range(self.nLeds)]
+
+    def processRefresh(self, command):
+        if len(command) != 3 or command[1] != " " or command[2] not in (RefreshTypeCode.PARTIAL.value, RefreshTypeCode.FULL.value, RefreshTypeCode.OFF.value):
+            self.error("E: Bad format.")
+            return
+        if command[2] == RefreshTypeCode.PARTIAL.value:
+            time.sleep(self.partialRefreshDelay)
+        elif command[2] == RefreshTypeCode.FULL.value:
+            time.sleep(self.fullRefreshDelay)
+        if command[2] != RefreshTypeCode.OFF.value:
+            self.display = bytes(self.ram)
+            self.refreshes.append(command[2])
+            if self.onRefresh != None:
+                self.onRefresh(command[2])
+        self.write("ok")
+
+    #Scripted input. Keys are numbered 1 (jog dial) to 9 like in the firmware.
+    def pressKey(self, key):
+        self.write(str(key) + ActionCode.PRESS.value)
+
+    def releaseKey(self, key):
+        self.write(str(key) + ActionCode.RELEASE.value)
+
+    def tapKey(self, key):
+        self.pressKey(key)
+        self.releaseKey(key)
+
+    def jog(self, steps):
+        self.write(KeyCode.JOG.value + str(steps))
+
+    #Returns the visible display content (or the content of the display RAM) as PIL image in the orientation the
+    #controller draws it
+    def getImage(self, ram=False):
+        from PIL import Image
+        return Image.frombytes("1", (self.dispW, self.dispH), bytes(self.ram if ram else self.display)).rotate(180)
+
+    def saveImage(self, path, ram=False):
+        self.getImage(ram).save(path)
+
+if __name__ == "__main__":
+    emulator = DeviceEmulator(baudrate=115200, partialRefreshDelay=0.3, fullRefreshDelay=2.0)
+    emulator.onRefresh = lambda refreshType: emulator.saveImage("emulator.png")
+    print("Emulating inkkeys on", emulator.start(), "- the display is saved to emulator.png after each refresh. Press Ctrl+c to quit.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
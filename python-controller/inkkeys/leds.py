@@ -0,0 +1,140 @@
+import time
+from collections import deque
+
+numpy = None #Optional, imported by the first LedEngine. Without numpy, the same is calculated in plain Python.
+
+def loadNumpy():
+    global numpy
+    if numpy == None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy
+
+#Fade curves map the remaining part of a fade (1 at the start, 0 at the end) to the brightness factor
+def linearCurve(p):
+    return p
+
+def quadraticCurve(p):
+    return p * p
+
+def smoothCurve(p):
+    return p * p * (3 - 2 * p)
+
+#Keeps the state of the LEDs and calculates their colors while they stay on and fade out. Each LED can have its own
+#hold and fade time and fade curve. frame() only returns new colors if at least one channel of one LED has changed
+#compared to what has been sent before, so no LED command is wasted on identical colors. With numpy, the colors of
+#all LEDs are calculated at once.
+class LedEngine:
+    holdTime = 3.0      #Default time the LEDs stay on after being set (in seconds)...
+    fadeTime = 0.5      #...before fading out over this time (in seconds)
+
+    def __init__(self, nLeds):
+        self.nLeds = nLeds
+        self.useNumpy = loadNumpy() != False
+        if self.useNumpy:
+            self.colors = numpy.zeros((nLeds, 3))           #Colors as set, one row of channels per LED
+            self.start = numpy.full(nLeds, -numpy.inf)      #Time each LED was set, -inf if it is off
+            self.hold = numpy.full(nLeds, float(self.holdTime))
+            self.fade = numpy.full(nLeds, float(self.fadeTime))
+        else:
+            self.colors = [(0, 0, 0)] * nLeds
+            self.start = [float("-inf")] * nLeds
+            self.hold = [self.holdTime] * nLeds
+            self.fade = [self.fadeTime] * nLeds
+        self.curves = [linearCurve] * nLeds
+        self.sent = None            #Channel values last sent to the device or None if unknown
+        self.frames = 0
+        self.commands = 0
+        self.commandTimes = deque() #Times of the LED commands in the last second
+
+    #Sets all LEDs to the given colors (as 0xRRGGBB integers). They stay on for hold seconds and then fade out over
+    #fade seconds. The defaults (None) keep the current durations of each LED, use float("inf") to keep them on.
+    def set(self, leds, now, hold=None, fade=None):
+        for i, color in enumerate(leds[:self.nLeds]):
+            self.setLed(i, color, now, hold, fade)
+
+    def setLed(self, index, color, now, hold=None, fade=None):
+        self.colors[index] = ((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff)
+        self.start[index] = now
+        if hold != None:
+            self.hold[index] = hold
+        if fade != None:
+            self.fade[index] = fade
+
+    #Sets the fade curve for one LED or for all of them if index is None
+    def setCurve(self, curve, index=None):
+        for i in (range(self.nLeds) if index == None else [index]):
+            self.curves[i] = curve
+
+    def setDuration(self, hold, fade, index=None):
+        for i in (range(self.nLeds) if index == None else [index]):
+            self.hold[i] = hold
+            self.fade[i] = fade
+
+    #The colors have to be sent again with the next frame, i.e. after reconnecting
+    def invalidate(self):
+        self.sent = None
+
+    #Remaining part of the fade for each LED: 1 while it is on, 0 once it has faded out
+    def remaining(self, now):
+        if self.useNumpy:
+            elapsed = now - self.start
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                p = numpy.where(self.fade > 0, (self.hold + self.fade - elapsed) / self.fade, numpy.where(elapsed < self.hold, 1.0, 0.0))
+            return numpy.nan_to_num(numpy.clip(p, 0, 1))
+        p = []
+        for start, hold, fade in zip(self.start, self.hold, self.fade):
+            elapsed = now - start
+            if fade > 0:
+                p.append(min(1, max(0, (hold + fade - elapsed) / fade)))
+            else:
+                p.append(1 if elapsed < hold else 0)
+        return p
+
+    def channels(self, now):
+        p = self.remaining(now)
+        if self.useNumpy:
+            factor = p
+            if any(curve is not linearCurve for curve in self.curves):
+                factor = numpy.array([curve(x) for curve, x in zip(self.curves, p)])
+            return (self.colors * factor[:, None]).astype(numpy.uint8).tobytes()
+        values = bytearray()
+        for color, curve, x in zip(self.colors, self.curves, p):
+            factor = curve(x)
+            values += bytes(int(c * factor) for c in color)
+        return bytes(values)
+
+    #Returns the colors for the LED command (as list of hex strings) or None if nothing has changed
+    def frame(self, now):
+        self.frames += 1
+        values = self.channels(now)
+        if values == self.sent:
+            return None
+        self.sent = values
+        self.commands += 1
+        self.commandTimes.append(now)
+        while self.commandTimes[0] < now - 1:
+            self.commandTimes.popleft()
+        colors = values.hex()
+        return [colors[i:i+6] for i in range(0, len(colors), 6)]
+
+    #Returns the time from which on frame() needs to be called for every frame or None if the colors will not change
+    def deadline(self, now):
+        lit = False
+        nextChange = float("inf")
+        for start, hold, fade in zip(self.start, self.hold, self.fade):
+            if now - start < hold + fade:
+                lit = True
+                nextChange = min(nextChange, max(now, float(start + hold)))
+        if self.sent == None:
+            return now if lit else None
+        if nextChange == float("inf"):
+            return now if self.sent != self.channels(now) else None
+        return nextChange
+
+    def stats(self, now=None):
+        if now == None:
+            now = time.time()
+        return {"frames": self.frames, "commands": self.commands, "suppressed": self.frames - self.commands, "commandsPerSecond": len([t for t in self.commandTimes if t >= now - 1]), "numpy": self.useNumpy}
@@ -0,0 +1,200 @@
+#A small metrics registry with counters, gauges and histograms. The metrics can be exported as Prometheus text file
+#(i.e. for the textfile collector of the node exporter) or as JSON, once or periodically from a background thread.
+#
+#Usage:
+#    sent = metrics.counter("inkkeys_sent_bytes_total", "Bytes sent to the device")
+#    sent.inc(42, command="DISPLAY")
+#    metrics.startExport("/var/lib/node_exporter/inkkeys.prom", 10)
+
+import os
+import time
+from threading import Lock, Thread, Event
+
+defaultBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+def formatLabels(key, extra=()):
+    items = list(key) + list(extra)
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(name + "=\"" + str(value).replace("\\", "\\\\").replace("\"", "\\\"") + "\"" for name, value in items) + "}"
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(labelKey(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [(key, value) for key, value in self.values.items()]
+
+    def toPrometheus(self):
+        return [self.name + formatLabels(key) + " " + formatValue(value) for key, value in self.samples()]
+
+    def toJson(self):
+        return [{"labels": dict(key), "value": value} for key, value in self.samples()]
+
+#A gauge either holds a value that is set explicitly or calls a function to get its value on export
+class Gauge(Counter):
+    type = "gauge"
+
+    def __init__(self, name, help, function=None):
+        Counter.__init__(self, name, help)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[labelKey(labels)] = value
+
+    def samples(self):
+        if self.function != None:
+            return [((), self.function())]
+        return Counter.samples(self)
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=defaultBuckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.values = {}    #Label key to [bucket counts, sum, count]
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    #Context manager to measure the duration of a block
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            return [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()]
+
+    def toPrometheus(self):
+        lines = []
+        for key, counts, total, count in self.samples():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(self.name + "_bucket" + formatLabels(key, [("le", formatValue(bound))]) + " " + str(cumulative))
+            lines.append(self.name + "_sum" + formatLabels(key) + " " + formatValue(total))
+            lines.append(self.name + "_count" + formatLabels(key) + " " + str(count))
+        return lines
+
+    def toJson(self):
+        result = []
+        for key, counts, total, count in self.samples():
+            cumulative = 0
+            buckets = {}
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                buckets[formatValue(bound)] = cumulative
+            result.append({"labels": dict(key), "count": count, "sum": total, "buckets": buckets})
+        return result
+
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+        self.exportThread = None
+        self.exportStop = None
+
+    #Returns the metric with the given name or creates it if it does not exist yet
+    def register(self, cls, name, *args):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.register(Counter, name, help)
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge, name, help, function)
+
+    def histogram(self, name, help, buckets=defaultBuckets):
+        return self.register(Histogram, name, help, buckets)
+
+    def toPrometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.type)
+            lines.extend(metric.toPrometheus())
+        return "\n".join(lines) + "\n"
+
+    def toJson(self):
+        import json
+        return json.dumps({"time": time.time(), "metrics": {metric.name: {"type": metric.type, "help": metric.help, "samples": metric.toJson()} for metric in list(self.metrics.values())}}, indent=2)
+
+    #Writes all metrics to a file. Files ending with ".json" get JSON, everything else the Prometheus text format.
+    #The file is replaced atomically, so readers never see a partially written file.
+    def export(self, path):
+        content = self.toJson() if path.endswith(".json") else self.toPrometheus()
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def startExport(self, path, interval=10):
+        self.stopExport()
+        self.exportStop = Event()
+        def run(stop):
+            while not stop.wait(interval):
+                try:
+                    self.export(path)
+                except OSError as e:
+                    print("Could not export metrics: ", e)
+        self.exportThread = Thread(target=run, args=(self.exportStop,), name="inkkeys-metrics", daemon=True)
+        self.exportThread.start()
+
+    def stopExport(self):
+        if self.exportThread != None:
+            self.exportStop.set()
+            self.exportThread.join()
+            self.exportThread = None
+
+metrics = MetricsRegistry() #Default registry used by the inkkeys module and the controller
@@ -1,5 +1,4 @@
 from enum import Enum
-from PIL import Image
 
 def event(device, keycode, value=""):
     if device == DELAY:
@@ -11,6 +10,25 @@ def event(device, keycode, value=""):
     else:
         return device.value + str(keycode.value)
 
+compiledSequences = {} #Interned sequences compiled with compileSequence, so identical ones share the same bytes object
+
+#Compiles a sequence of events (as returned by event()) into its encoded form for the ASSIGN command. Sequences that
+#never change should be compiled once (i.e. as class attribute of a mode) and passed to Device.assignKey instead of
+#the list, so they are not joined and encoded again on every activation. Compiled sequences are passed through.
+def compileSequence(sequence):
+    if isinstance(sequence, bytes):
+        return sequence
+    encoded = encodeSequence(sequence)
+    return compiledSequences.setdefault(encoded, encoded)
+
+#Encodes a sequence without interning it, for sequences that are built on the fly
+def encodeSequence(sequence):
+    return "".join(" " + e for e in sequence).encode()
+
+#Returns the complete ASSIGN command (including the line break) for a key and a sequence (compiled or not)
+def compileAssign(key, sequence):
+    return assignPrefixes[key.value] + (sequence if isinstance(sequence, bytes) else encodeSequence(sequence)) + b"\n"
+
 class CommandCode(Enum):
     ASSIGN = "A"
     DISPLAY = "D"
@@ -326,5 +344,5 @@ class MouseAxisCode(Enum):
     MOUSE_Y = "y"
     MOUSE_WHEEL = "w"
 
-
-
+#Encoded start of the ASSIGN command for each key, used by compileAssign
+assignPrefixes = {key.value: (CommandCode.ASSIGN.value + " " + key.value).encode() for key in KeyCode}
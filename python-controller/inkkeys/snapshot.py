@@ -0,0 +1,35 @@
+import os
+
+#Recording of everything a mode does to the device in its activate function: the packed display regions, the key
+#assignments, callbacks, LEDs, refresh requests and commands sent directly (all methods of Device marked with
+#@recorded). Replaying it has the same effect as calling activate again, but nothing needs to be rendered. Only valid
+#as long as the icon files used by the mode do not change and the display has the same size.
+
+class ModeSnapshot:
+    def __init__(self, dispW, dispH):
+        self.dispW = dispW
+        self.dispH = dispH
+        self.steps = []     #(method name, arguments, keyword arguments) in the order they were called
+        self.files = {}     #Files used for rendering to their modification time
+
+    def record(self, method, args, kwargs):
+        self.steps.append((method, args, kwargs))
+
+    def recordFile(self, path, mtime):
+        self.files[path] = mtime
+
+    def isValidFor(self, device):
+        if self.dispW != device.dispW or self.dispH != device.dispH:
+            return False
+        for path, mtime in self.files.items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return False
+            except OSError:
+                if mtime != None:
+                    return False
+        return True
+
+    def replay(self, device):
+        for method, args, kwargs in self.steps:
+            getattr(device, method)(*args, **kwargs)
@@ -0,0 +1,63 @@
+from inkkeys import LRUCache, metrics
+import time
+
+matchMetric = metrics.histogram("inkkeys_mode_match_seconds", "Time spent deciding which mode to use (without cache hits)")
+
+#Decides which mode to use for the active window and the running processes. The list of modes (as defined in
+#controller.py) is evaluated in order and the first matching mode wins, just like before, but the result is memoized
+#per window and set of running processes that are relevant to any mode. So the regular expressions are only run again
+#if the window or one of these processes changes.
+#Modes can be given as classes instead of objects. They are only instantiated when they match for the first time, so
+#modes for rarely used applications cost nothing at startup. Each matcher has its own instances.
+class ModeMatcher:
+    def __init__(self, modes, maxCacheSize=256):
+        self.entries = [(i["mode"], i.get("process"), i.get("activeWindow")) for i in modes]
+        self.instances = {}                 #Index of an entry to the instance of its mode class
+        self.processes = frozenset(i["process"] for i in modes if "process" in i) #Only these processes affect the result
+        self.cache = LRUCache(maxCacheSize) #(window, relevant processes) to index of the matching entry
+        self.lastKey = None
+        self.lastIndex = None
+        self.evaluations = 0
+        self.matchTime = 0
+
+    #Returns the mode for the window and the set of running processes or None if no mode matches
+    def match(self, window, processes):
+        key = (window, self.processes & frozenset(processes))
+        if key == self.lastKey:         #Nothing changed since the last call, which is by far the most common case
+            index = self.lastIndex
+        else:
+            index = self.cache.get(key)
+            if index == None:
+                index = self.evaluate(window, key[1])
+                self.cache.put(key, index)
+            self.lastKey = key
+            self.lastIndex = index
+        return self.getMode(index) if index >= 0 else None
+
+    def getMode(self, index):
+        mode = self.entries[index][0]
+        if not isinstance(mode, type):
+            return mode
+        if index not in self.instances:
+            self.instances[index] = mode()
+        return self.instances[index]
+
+    def evaluate(self, window, processes):
+        start = time.perf_counter()
+        result = -1
+        for index, (mode, process, activeWindow) in enumerate(self.entries):
+            if (process != None and process in processes) or (activeWindow != None and window != None and activeWindow.match(window)) or (process == None and activeWindow == None):
+                result = index
+                break
+        duration = time.perf_counter() - start
+        self.evaluations += 1
+        self.matchTime += duration
+        matchMetric.observe(duration)
+        return result
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["evaluations"] = self.evaluations
+        stats["matchTime"] = self.matchTime
+        stats["averageMatchTime"] = self.matchTime / self.evaluations if self.evaluations > 0 else 0
+        return stats
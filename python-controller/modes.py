@@ -6,66 +6,84 @@
 #- poll
 #Called periodically and typically used to poll a state which you need to monitor. At the end you have to return an interval in seconds before the function is to be called again - otherwise it is not called a second time
 #- animate
-#Called up to 30 times per second, used for LED animation
+#Called up to 30 times per second while the LEDs are fading, used for LED animation. Return True if you need to be called again for the next frame, otherwise the controller stops calling it until the LEDs change
 #- deactivate
 #Called when the mode becomes inactive. Used to clean up callback functions and images on the screen that are outside commonly overwritten areas.
 
 #To avoid multiple screen refreshs, the modules usually do not clean-up the display when being deactivvated. Instead, each module is supposed to set at least the area corresponding to each button (even if it needs to be set to white if unused).
+#For the same reason, modes do not refresh the display themselves but call device.requestRefresh(). The controller then does a single (usually partial) refresh for all changes made in quick succession.
+
+#Modes that always do the same thing in "activate" (only calling functions of the device without any state of their own) can set "snapshot = True". Their activation is then recorded once and replayed on later activations without rendering the images again (see Device.activateMode). Set "self.changed = True" if you need the mode to be recorded again.
+
+#Key sequences that never change can be compiled once with compileSequence (i.e. as class attributes like in ModeAltium) and passed to device.assignKey instead of the list, so they are not encoded again on every activation.
 
 from inkkeys import *
 import time
 from threading import Timer
 from math import ceil, floor
-from PIL import Image, ImageDraw, ImageFont
 from colorsys import hsv_to_rgb
 
 class ModeAltium:
     jogFunction = ""    #Keeps track of the currently selected function of the jog dial
+    snapshot = True     #activate() always sends the same, so it can be replayed
+
+    #Key chords, compiled once so activating the mode does not encode them again (see compileSequence)
+    sw2Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_W, ActionCode.PRESS)])
+    sw2Release = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_W, ActionCode.RELEASE)])
+    sw3Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.RELEASE)])
+    sw4Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_E, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_E, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_D, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_D, ActionCode.RELEASE)])
+    sw5Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_N, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_N, ActionCode.RELEASE)])
+    sw6Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE)])
+    sw7Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_V, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_V, ActionCode.RELEASE)])
+    sw7Release = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.RELEASE)])
+    sw8Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.RELEASE)])
+    sw8Release = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_A, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_A, ActionCode.RELEASE)])
+    sw9Press = compileSequence([event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.RELEASE)])
 
     def activate(self, device):
         device.sendTextFor("title", "Altium", inverted=True)  #Title
 
         #Button2 (top left) WIRE
         device.sendIconFor(2, "icons/slash.png")    
-        device.assignKey(KeyCode.SW2_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_W, ActionCode.PRESS)]) 
-        device.assignKey(KeyCode.SW2_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_W, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW2_PRESS, self.sw2Press) 
+        device.assignKey(KeyCode.SW2_RELEASE, self.sw2Release)
 
         #Button3 (left, second from top) MOVE
         device.sendIconFor(3, "icons/arrows-move.png")
-        device.assignKey(KeyCode.SW3_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_M, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW3_PRESS, self.sw3Press)
         device.assignKey(KeyCode.SW3_RELEASE, [])
 
         #Button4 (left, third from top) DELETE
         device.sendIconFor(4, "icons/trash.png")
-        device.assignKey(KeyCode.SW4_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_E, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_E, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_D, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_D, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW4_PRESS, self.sw4Press)
         device.assignKey(KeyCode.SW4_RELEASE, [])
 
         #Button5 (bottom left) PLACE NET
         device.sendIconFor(5, "icons/place_net.png")
-        device.assignKey(KeyCode.SW5_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_N, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_N, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW5_PRESS, self.sw5Press)
         device.assignKey(KeyCode.SW5_RELEASE, [])
 
         #Button6 (top right) PLACE TEXT or INTERACTIVE ROUTING
         device.sendIconFor(6, "icons/textarea-t.png")
-        device.assignKey(KeyCode.SW6_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW6_PRESS, self.sw6Press)
         device.assignKey(KeyCode.SW6_RELEASE, [])
 
         #Button7 (right, second from top) CREATE POLYGON FROM SELECTED PRIMITIVES
         device.sendIconFor(7, "icons/create_polygon_from_selected.png")
-        device.assignKey(KeyCode.SW7_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_V, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_V, ActionCode.RELEASE)])
-        device.assignKey(KeyCode.SW7_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW7_PRESS, self.sw7Press)
+        device.assignKey(KeyCode.SW7_RELEASE, self.sw7Release)
 
         #Button8 (right, third from top) REPOUR ALL POLYGONS 
         device.sendIconFor(8, "icons/repour_polygon.png")
-        device.assignKey(KeyCode.SW8_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.RELEASE)])
-        device.assignKey(KeyCode.SW8_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_A, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_A, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW8_PRESS, self.sw8Press)
+        device.assignKey(KeyCode.SW8_RELEASE, self.sw8Release)
 
         #Button9 (bottom right) PLACE POLYGON
         device.sendIconFor(9, "icons/bounding-box-circles.png")
-        device.assignKey(KeyCode.SW9_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_P, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_G, ActionCode.RELEASE)])
+        device.assignKey(KeyCode.SW9_PRESS, self.sw9Press)
         device.assignKey(KeyCode.SW9_RELEASE, [])
 
-        device.updateDisplay()
+        device.requestRefresh()
 
     def poll(self, device):
         return False #Nothing to poll
@@ -78,6 +96,7 @@ class ModeAltium:
 
 class ModeZoom:
     jogFunction = ""    #Keeps track of the currently selected function of the jog dial
+    snapshot = True     #activate() always sends the same, so it can be replayed
 
     def activate(self, device):
         device.sendTextFor("title", "Zoom", inverted=True)  #Title
@@ -122,7 +141,7 @@ class ModeZoom:
         device.assignKey(KeyCode.SW9_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS)]) 
         device.assignKey(KeyCode.SW9_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE)])
 
-        device.updateDisplay()
+        device.requestRefresh()
 
     def poll(self, device):
         return False #Nothing to poll
@@ -135,6 +154,7 @@ class ModeZoom:
 
 class ModeMicrosoftTeams:
     jogFunction = ""    #Keeps track of the currently selected function of the jog dial
+    snapshot = True     #activate() always sends the same, so it can be replayed
 
     def activate(self, device):
         device.sendTextFor("title", "Teams", inverted=True)  #Title
@@ -179,7 +199,7 @@ class ModeMicrosoftTeams:
         device.assignKey(KeyCode.SW9_PRESS, [])
         device.assignKey(KeyCode.SW9_RELEASE, [])
 
-        device.updateDisplay()
+        device.requestRefresh()
 
     def poll(self, device):
         return False #Nothing to poll
@@ -192,6 +212,7 @@ class ModeMicrosoftTeams:
 
 class ModeTest:
     jogFunction = ""    #Keeps track of the currently selected function of the jog dial
+    snapshot = True     #activate() always sends the same, so it can be replayed
 
     def activate(self, device):
         device.sendTextFor("title", "Test", inverted=True)  #Title
@@ -205,7 +226,7 @@ class ModeTest:
         device.sendTextFor(8, "SW8 ", inverted=False)
         device.sendTextFor(9, "SW9 ", inverted=False)
 
-        device.updateDisplay()
+        device.requestRefresh()
 
     def poll(self, device):
         return False #Nothing to poll
@@ -226,7 +247,7 @@ class ModeFallback:
     def activate(self, device):
         self.jogFunction = "Menu1"
 
-        #This toggles the jog function and sets up key assignments and the label for the jog dial. It calls "updateDiplay()" if update is not explicitly set to False (for example if you need to update more parts of the display before updating it.)
+        #This toggles the jog function and sets up key assignments and the label for the jog dial. It calls "requestRefresh()" if update is not explicitly set to False (for example if you need to update more parts of the display before updating it.)
         def toggleJogFunction(update=True):
             if self.jogFunction == "Menu1":  
                 device.clearCallback(KeyCode.JOG)
@@ -258,7 +279,7 @@ class ModeFallback:
                 device.assignKey(KeyCode.SW9_RELEASE, [event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_CALCULATOR, ActionCode.RELEASE)])
                 self.jogFunction = "Menu2"
                 if update:
-                    device.updateDisplay()
+                    device.requestRefresh()
             else:                            #Tool size in GIMP
                 device.clearCallback(KeyCode.JOG)
                 device.sendTextFor(1, "Next Menu")
@@ -289,14 +310,14 @@ class ModeFallback:
                 device.assignKey(KeyCode.SW9_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_7, ActionCode.RELEASE)])
                 self.jogFunction = "Menu1"
                 if update:
-                    device.updateDisplay()
+                    device.requestRefresh()
 
         #Button 1 / jog dial press
         device.registerCallback(toggleJogFunction, KeyCode.JOG_PRESS)   #Call "toggleJogFunction" if the dial is pressed
         device.assignKey(KeyCode.SW1_PRESS, [])                         #We do not send a key stroke when the dial is pressed, instead we use the callback.
         device.assignKey(KeyCode.SW1_RELEASE, [])                       #We still need to overwrite the assignment to clear previously set assignments.
         toggleJogFunction(False)                                        #We call toggleJogFunction to initially set the label and assignment
-        device.updateDisplay()                                          #Everything has been sent to the display. Time to refresh it.
+        device.requestRefresh()                                         #Everything has been sent to the display. Time to refresh it.
 
     def poll(self, device):
         return False #No polling required
@@ -1,11 +1,17 @@
 import sys
-import psutil
+import os
+import socket
+import struct
+import select
+import errno
+import time
+from collections import namedtuple
+from threading import Lock, Thread, Event
 
 if sys.platform in ['linux', 'linux2']:
-    import Xlib
-    import Xlib.display
-    display = Xlib.display.Display()
-    root = display.screen().root
+    Xlib = None     #Xlib and the display are only loaded when the active window is needed for the first time (see openDisplay)
+    display = None
+    root = None
 elif sys.platform in ['Windows', 'win32', 'cygwin']:
     import win32gui
 elif sys.platform in ['Mac', 'darwin', 'os2', 'os2emx']:
@@ -13,15 +19,310 @@ elif sys.platform in ['Mac', 'darwin', 'os2', 'os2emx']:
 else:
     print("Unknown platform: " + sys.platform)
 
+#Keeps track of the names of running processes without a full scan each time. Names are only resolved for PIDs that
+#are new since the last scan (with psutil only if they might be watched) and PIDs of exited processes are dropped. On Linux, the kernel's process connector is
+#used if permitted (root or CAP_NET_ADMIN in the initial namespaces), so the tracker is notified about new and exited
+#processes and only needs a slow safety scan. If a set of names to watch is given, only those names are reported and
+#nothing is tracked at all if the set is empty.
+class ProcessTracker:
+    safetyScanInterval = 60 #Scan anyway if the connector has not reported any event for this long (in seconds)
+
+    def __init__(self, watch=None):
+        self.watch = set(watch) if watch != None else None
+        self.names = {}         #PID to process name
+        self.young = set()      #PIDs first seen in the last scan. Resolved once more as they might not have called exec yet.
+        self.lock = Lock()
+        self.connector = None
+        self.connectorFailed = not sys.platform in ['linux', 'linux2']
+        self.lastScan = 0
+
+    #Returns the name of a process or None if it does not exist (anymore)
+    def lookup(self, pid):
+        import psutil
+        try:
+            return psutil.Process(pid).name()
+        except (psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied):
+            return None
+
+    #Returns the name of a process, but only looks it up with psutil (which gets the full name) if the cheap and
+    #possibly truncated command name in /proc might be one of the watched names. Without /proc, psutil is always used.
+    def quickLookup(self, pid):
+        try:
+            with open("/proc/" + str(pid) + "/comm") as f:
+                comm = f.read().rstrip("\n")
+        except OSError:
+            return self.lookup(pid)
+        return self.lookup(pid) if self.mightBeWatched(comm) else comm
+
+    def resolve(self, pid):
+        name = self.quickLookup(pid)
+        if name != None:
+            self.names[pid] = name
+        else:
+            self.names.pop(pid, None)
+
+    #True if a process with this (possibly truncated) command name might be one of the watched processes
+    def mightBeWatched(self, comm):
+        return self.watch == None or any(name[:15] == comm for name in self.watch)
+
+    def scan(self):
+        import psutil
+        pids = set(psutil.pids())
+        with self.lock:
+            for pid in self.names.keys() - pids:
+                del self.names[pid]
+            new = pids - self.names.keys()
+            for pid in new | (self.young & pids):
+                self.resolve(pid)
+            self.young = new
+            self.lastScan = time.time()
+
+    def startConnector(self):
+        try:
+            self.connector = ProcConnector(self)
+        except OSError:
+            self.connector = None #Not permitted or not supported. Fall back to scanning.
+            self.connectorFailed = True
+
+    def getActiveProcesses(self):
+        if self.watch != None and len(self.watch) == 0:
+            return set()
+        if self.connector == None and not self.connectorFailed:
+            self.startConnector()
+        if self.connector == None or not self.connector.running or time.time() - max(self.connector.lastEvent, self.lastScan) > self.safetyScanInterval:
+            self.scan()
+        with self.lock:
+            names = set(self.names.values())
+        return names if self.watch == None else names & self.watch
+
+#Receives fork, exec and exit events from the Linux process connector and updates a ProcessTracker. The kernel
+#ignores the subscription in other PID or user namespaces (i.e. in containers), so it is only used if the kernel
+#acknowledges it. If the socket fails, the connector stops and the tracker falls back to scanning.
+class ProcConnector:
+    NETLINK_CONNECTOR = 11
+    CN_IDX_PROC = 1
+    CN_VAL_PROC = 1
+    NLMSG_DONE = 3
+    PROC_CN_MCAST_LISTEN = 1
+    PROC_EVENT_NONE = 0x00000000
+    PROC_EVENT_FORK = 0x00000001
+    PROC_EVENT_EXEC = 0x00000002
+    PROC_EVENT_EXIT = 0x80000000
+    ackTimeout = 1 #Time to wait for the kernel to acknowledge the subscription (in seconds)
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.running = False
+        self.lastEvent = 0
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_CONNECTOR)
+        try:
+            self.sock.bind((0, self.CN_IDX_PROC))
+            payload = struct.pack("=I", self.PROC_CN_MCAST_LISTEN)
+            message = struct.pack("=IIIIHH", self.CN_IDX_PROC, self.CN_VAL_PROC, 0, 0, len(payload), 0) + payload
+            self.sock.send(struct.pack("=IHHII", 16 + len(message), self.NLMSG_DONE, 0, 0, os.getpid()) + message)
+            self.waitForAck()
+        except OSError:
+            self.sock.close()
+            raise
+        tracker.scan() #Initial state. Events from here on are received by the thread.
+        self.lastEvent = time.time()
+        self.running = True
+        self.thread = Thread(target=self.run, name="inkkeys-procconnector", daemon=True)
+        self.thread.start()
+
+    #The kernel answers the subscription with a PROC_EVENT_NONE message carrying an error code. Events that arrive
+    #before it are dropped, as the initial scan follows anyway.
+    def waitForAck(self):
+        deadline = time.time() + self.ackTimeout
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0 or len(select.select([self.sock], [], [], timeout)[0]) == 0:
+                raise OSError("The process connector did not acknowledge the subscription.")
+            data = self.sock.recv(4096)
+            for offset in self.messages(data):
+                if offset + 20 <= len(data) and struct.unpack_from("=I", data, offset)[0] == self.PROC_EVENT_NONE:
+                    err = struct.unpack_from("=I", data, offset + 16)[0]
+                    if err != 0:
+                        raise OSError(err, "The process connector rejected the subscription.")
+                    return
+
+    #Offsets of the proc_event structures in a datagram
+    def messages(self, data):
+        offset = 0
+        while offset + 16 <= len(data):
+            length = struct.unpack_from("=I", data, offset)[0]
+            if length < 16:
+                break
+            yield offset + 16 + 20 #Skip nlmsghdr and cn_msg
+            offset += (length + 3) & ~3
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.sock.recv(4096)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    #We did not keep up with the events. Get back in sync with a scan.
+                    self.tracker.scan()
+                    continue
+                print("Process connector failed, falling back to scanning: ", e)
+                self.running = False
+                self.sock.close()
+                return
+            self.lastEvent = time.time()
+            for offset in self.messages(data):
+                self.handle(data, offset)
+
+    def handle(self, data, offset):
+        if offset + 16 > len(data):
+            return
+        what = struct.unpack_from("=I", data, offset)[0]
+        offset += 16 #Skip what, cpu and timestamp
+        if what == self.PROC_EVENT_FORK:
+            parentPid, parentTgid, childPid, childTgid = struct.unpack_from("=iiii", data, offset)
+            with self.tracker.lock:
+                if childPid == childTgid and parentTgid in self.tracker.names: #New process, not a new thread. It keeps the parent's name until exec.
+                    self.tracker.names[childPid] = self.tracker.names[parentTgid]
+        elif what == self.PROC_EVENT_EXEC:
+            pid, tgid = struct.unpack_from("=ii", data, offset)
+            name = self.tracker.quickLookup(tgid) #Without holding the lock
+            with self.tracker.lock:
+                if name != None:
+                    self.tracker.names[tgid] = name
+                else:
+                    self.tracker.names.pop(tgid, None)
+        elif what == self.PROC_EVENT_EXIT:
+            pid, tgid = struct.unpack_from("=ii", data, offset)
+            if pid == tgid:
+                with self.tracker.lock:
+                    self.tracker.names.pop(pid, None)
+
+tracker = None #Default tracker used by getActiveProcesses()
+
+#Limit getActiveProcesses() to these process names (i.e. the ones referenced by modes), so nothing else needs to be tracked
+def watchProcesses(names):
+    global tracker
+    if tracker == None:
+        tracker = ProcessTracker(names)
+    else:
+        tracker.watch = set(names)
+
 def getActiveProcesses():
-    return {p.name() for p in psutil.process_iter(["name"])}
+    global tracker
+    if tracker == None:
+        tracker = ProcessTracker()
+    return tracker.getActiveProcesses()
+
+#Watches the active window on X11 instead of polling it. The root window is selected for property changes, so the
+#X server tells us when _NET_ACTIVE_WINDOW changes and there is no X traffic at all while the focus is stable. The
+#window class is cached per window id. The watcher uses its own connection to the X server in a background thread and
+#calls the callback (if set) with the new window class on every focus change.
+class ActiveWindowWatcher:
+    maxCachedClasses = 256
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.classes = {}           #Window id to window class
+        self.activeWindow = None
+        self.changes = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        loadXlib()
+        self.display = Xlib.display.Display()
+        self.root = self.display.screen().root
+        self.atom = self.display.intern_atom('_NET_ACTIVE_WINDOW')
+        self.root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        self.update()
+        self.running = True
+        self.thread = Thread(target=self.run, name="inkkeys-windowwatcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+        self.display.close()
+
+    def run(self):
+        while self.running:
+            if self.display.pending_events() == 0:
+                select.select([self.display.fileno()], [], [], 1.0) #Timeout, so stop() does not wait forever
+                continue
+            event = self.display.next_event()
+            if event.type == Xlib.X.PropertyNotify and event.atom == self.atom:
+                self.update()
+
+    def getClass(self, windowID):
+        if windowID in self.classes:
+            return self.classes[windowID]
+        wmClass = self.display.create_resource_object('window', windowID).get_wm_class()
+        if wmClass == None:
+            return None #Not set (yet), so do not cache it
+        if len(self.classes) >= self.maxCachedClasses:
+            self.classes.clear()
+        self.classes[windowID] = wmClass[0]
+        return wmClass[0]
+
+    def update(self):
+        windowID = 0
+        try:
+            prop = self.root.get_full_property(self.atom, Xlib.X.AnyPropertyType)
+            windowID = prop.value[0] if prop != None and len(prop.value) > 0 else 0
+            window = self.getClass(windowID) if windowID != 0 else None
+        except Xlib.error.XError:
+            self.classes.pop(windowID, None) #Window was destroyed in the meantime
+            window = None
+        if window == None or window == self.activeWindow:
+            return
+        self.activeWindow = window
+        self.changes += 1
+        if self.callback != None:
+            self.callback(window)
+
+windowWatcher = None #Used by getActiveWindow() once started with watchActiveWindow()
+
+#Starts watching the active window, so getActiveWindow() just returns the last known window and the callback is
+#called on focus changes. Only supported on X11, returns False if getActiveWindow() keeps polling.
+def watchActiveWindow(callback=None):
+    global windowWatcher
+    if sys.platform not in ['linux', 'linux2']:
+        return False
+    if windowWatcher == None:
+        watcher = ActiveWindowWatcher(callback)
+        try:
+            watcher.start()
+        except Exception:
+            print("Could not watch active window: ", sys.exc_info()[0])
+            return False
+        windowWatcher = watcher
+    else:
+        windowWatcher.callback = callback
+    return True
+
+def loadXlib():
+    global Xlib
+    import Xlib.display
+    import Xlib.error
+
+def openDisplay():
+    global display, root
+    if display == None:
+        loadXlib()
+        display = Xlib.display.Display()
+        root = display.screen().root
 
 # Adapted from Martin Thoma on stackoverflow
 # https://stackoverflow.com/a/36419702/8068814
 def getActiveWindow():
     active_window_name = None
+    if windowWatcher != None:
+        return windowWatcher.activeWindow
     try:
         if sys.platform in ['linux', 'linux2']:
+            openDisplay()
             windowID = root.get_full_property(display.intern_atom('_NET_ACTIVE_WINDOW'), Xlib.X.AnyPropertyType).value[0]
             window = display.create_resource_object('window', windowID)
             return window.get_wm_class()[0]
@@ -33,3 +334,60 @@ def getActiveWindow():
     except:
         print("Could not get active window: ", sys.exc_info()[0])
     return active_window_name
+
+#What the controller needs to know to decide on a mode. Published as a whole, so readers never see a half update.
+ContextSnapshot = namedtuple("ContextSnapshot", ["window", "processes", "timestamp"])
+
+#Runs getActiveProcesses() and getActiveWindow() in a background thread at their own intervals, so the main loop
+#(key callbacks and LED animation) never has to wait for a process scan or the X server. The result is published
+#in snapshot and onChange (if set) is called with the new snapshot if the window or the processes have changed.
+#With windowInterval set to None, the window is only checked when probeWindow() is called (i.e. by a window watcher).
+class ContextProbe:
+    processInterval = 5.0   #Interval for checking the process list
+    windowInterval = 0.5    #Interval for checking the active window
+
+    def __init__(self, onChange=None, getProcesses=getActiveProcesses, getWindow=getActiveWindow):
+        self.onChange = onChange
+        self.getProcesses = getProcesses
+        self.getWindow = getWindow
+        self.snapshot = ContextSnapshot(None, frozenset(), 0)
+        self.wakeup = Event()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run, name="inkkeys-contextprobe", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    #Check the active window right away
+    def probeWindow(self):
+        self.wakeup.set()
+
+    def run(self):
+        nextProcesses = 0
+        nextWindow = 0
+        while self.running:
+            now = time.time()
+            window, processes = self.snapshot.window, self.snapshot.processes
+            if now >= nextProcesses:
+                processes = frozenset(self.getProcesses())
+                nextProcesses = now + self.processInterval
+            if self.wakeup.is_set() or (nextWindow != None and now >= nextWindow):
+                self.wakeup.clear()
+                newWindow = self.getWindow()
+                if newWindow != None: #Sometime getting the active window fails, then keep the last one
+                    window = newWindow
+                nextWindow = now + self.windowInterval if self.windowInterval != None else None
+            changed = window != self.snapshot.window or processes != self.snapshot.processes
+            self.snapshot = ContextSnapshot(window, processes, now)
+            if changed and self.onChange != None:
+                self.onChange(self.snapshot)
+            self.wakeup.wait(max(0, min(nextProcesses, nextWindow if nextWindow != None else nextProcesses) - time.time()))
@@ -0,0 +1,43 @@
+import unittest
+from inkkeys import Device
+
+#Device without a serial port that collects everything it would write
+def offlineDevice():
+    device = Device()
+    device.dispW, device.dispH = 128, 296
+    device.bufferWrites = True
+    device.outbuffer = bytearray()
+    device.resetFramebuffer()
+    return device
+
+#Headers of the DISPLAY commands in written data, skipping their binary payload
+def displayCommands(data):
+    data = bytes(data)
+    commands = []
+    while len(data) > 0:
+        line, data = data.split(b"\n", 1)
+        if line.startswith(b"D "):
+            commands.append(line)
+            w, h = [int(v) for v in line.split()[3:5]]
+            data = data[w * h // 8:]
+    return commands
+
+class ImageBufferTest(unittest.TestCase):
+    def testUntrackableRegionsAreResent(self):
+        device = offlineDevice()
+        n = device.maxImageBuffer + 8
+        for i in range(n):
+            device.sendImageData(4, i * 2, 8, 1, bytes([i])) #Not byte-aligned, so the mirror cannot merge them
+        self.assertEqual(len(device.imageBuffer), n)
+        device.outbuffer = bytearray()
+        device.resendImageData()
+        self.assertEqual(displayCommands(device.outbuffer), [("D 4 " + str(i * 2) + " 8 1").encode() for i in range(n)])
+
+    def testTrackableRegionsAreMerged(self):
+        device = offlineDevice()
+        for i in range(device.maxImageBuffer + 8):
+            device.sendImageData(0, i, 8, 1, bytes([i])) #Adjacent rows, so the mirror knows everything in between
+        self.assertLessEqual(len(device.imageBuffer), device.maxImageBuffer)
+
+if __name__ == "__main__":
+    unittest.main()